@@ -1,10 +1,20 @@
-from mosaic.etl import run_etl
-from mosaic.utils import convert_vector_to_date, lookup_yaml
+from mosaic.etl import LastRun
+from mosaic.load import (
+    load_daily_skis,
+    load_hourly_heart_rate,
+    load_skis,
+    load_transactions,
+    load_vitals_stats,
+    load_weekly_variable_spend,
+)
+from mosaic.refresh import start_background_refresher
+from mosaic.utils import lookup_yaml
 import altair as alt
 import datetime
 import inflection
 import logging as getLogger
 import numpy as np
+import os
 import pandas as pd
 import streamlit as st
 
@@ -16,19 +26,6 @@ def format_thousands(value):
     return f"{value:,.0f}"
 
 
-def most_recent_value(
-    long_df, category, category_col="type", value_col="value", date_col="date"
-):
-    # Expects long data
-    last_value = (
-        long_df.sort_values(date_col)
-        .loc[long_df[category_col] == category, value_col]
-        .dropna()
-        .iloc[-1]
-    )
-    return last_value
-
-
 def plot_dual_axis(shared_x, line_y, bar_y, df):
     # Expects wide data
     base = alt.Chart(df).encode(x=f"{shared_x}:T")
@@ -48,14 +45,33 @@ def write_goal_checklist(goals: list):
 def trailing_date(weeks):
     return np.datetime64('today') - np.timedelta64(weeks, 'W')
 
+def write_data_freshness(refresher):
+    last_run_time = LastRun().read_time()
+    caption = "No refresh has finished yet"
+    if last_run_time is not None:
+        caption = f"Data as of {last_run_time:%b %d, %Y %H:%M}"
+    if refresher.running.is_set():
+        caption += " · refreshing in the background"
+    st.caption(caption)
+
+
 def main():
     config = lookup_yaml("etl_config.yml")
-    run_etl()
+    # The ETL runs on its own thread so page loads only ever read the latest outputs
+    refresher = start_background_refresher()
     st.title("🏔 Review")
+    write_data_freshness(refresher)
+    output_paths = [
+        config["transform"][t]["output_path"] for t in ["skis", "transactions", "vitals_stats"]
+    ]
+    if not all(os.path.exists(path) for path in output_paths):
+        st.info("Mosaic is assembling your data for the first time. Check back in a few minutes.")
+        st.stop()
     write_goal_checklist(["Tour Shasta", "Climb Serengeti", "Buy home"])
     skiing, spending, health = st.tabs(["Skiing", "Spending", "Health"])
     with skiing:
-        ski = pd.read_csv(config["transform"]["skis"]["output_path"])
+        # Loaders hand back frames cached until the ETL rewrites their file, so they aren't modified here
+        ski = load_skis(config["transform"]["skis"]["output_path"])
         metrics = st.columns(5)
         tour_count = ski.loc[ski["type"] == "backcountry_ski", "date"].nunique()
         alpine_vert = ski.loc[ski["type"] == "alpine_ski", "total_elevation_gain"].sum()
@@ -89,20 +105,16 @@ def main():
             )
         st.write()
 
-        ski = ski.groupby("date", as_index=False).agg(
-            {"total_elevation_gain": "sum", "max_speed": "max"}
-        )
-        ski["season_elevation_gain"] = ski["total_elevation_gain"].cumsum().astype(int)
+        ski = load_daily_skis(config["transform"]["skis"]["output_path"])
         plot_dual_axis(
             shared_x="date", line_y="season_elevation_gain", bar_y="max_speed", df=ski
         )
 
     with spending:
         metrics = st.columns(3)
-        spend = pd.read_csv(config["transform"]["transactions"]["output_path"])
+        spend = load_transactions(config["transform"]["transactions"]["output_path"])
         trailing_week = trailing_date(weeks=1)
         trailing_quarter = trailing_date(weeks=12)
-        spend["date"] = convert_vector_to_date(spend["date"])
         with metrics[0]:
             weekly_restaurant_spend = (
                 spend.loc[spend["date"] >= trailing_week]
@@ -145,10 +157,8 @@ def main():
         with metrics[2]:
             pass
 
-        weekly_variable_spend = (
-            spend.loc[spend["is_variable"], ["week", "category", "amount"]]
-            .groupby(["week", "category"], as_index=False)
-            .sum()
+        weekly_variable_spend = load_weekly_variable_spend(
+            config["transform"]["transactions"]["output_path"]
         )
         st.altair_chart(
             alt.Chart(weekly_variable_spend)
@@ -160,25 +170,42 @@ def main():
             ),
             use_container_width=True,
         )
-        spend = spend[["date", "name", "account", "category", "amount"]]
-        spend["amount"] = spend["amount"].astype(int)
+        recent_spend = (
+            spend[["date", "name", "account", "category", "amount"]]
+            .sort_values("date", ascending=False)
+            .head(50)
+            .astype({"amount": int})
+        )
         with st.expander("Transactions"):
-            st.table(spend.sort_values("date", ascending=False).head(50))
+            st.table(recent_spend)
     with health:
         metric_values = ["resting_heart_rate", "sleep_hours", "weight", "bmi"]
         metrics = st.columns(len(metric_values))
-        vitals = pd.read_csv(config["transform"]["vitals"]["output_path"])
-        vitals["date"] = convert_vector_to_date(vitals["date"])
+        # Latest values and trailing means are precomputed by the vitals_stats transform
+        vitals = load_vitals_stats(config["transform"]["vitals_stats"]["output_path"])
+        latest = vitals.iloc[-1] if not vitals.empty else None
         for i, value in enumerate(metric_values):
             with metrics[i]:
-                last_value = f"{most_recent_value(vitals,value):.1f}"
-                st.metric(label=inflection.titleize(value), value=last_value)
-        vitals = vitals.pivot_table(
-            values="value", index="date", columns="type"
-        ).reset_index()
+                if latest is None:
+                    st.metric(label=inflection.titleize(value), value="-")
+                    continue
+                st.metric(
+                    label=inflection.titleize(value),
+                    value=f"{latest[f'{value}_latest']:.1f}",
+                    delta=f"{latest[f'{value}_7d'] - latest[f'{value}_baseline']:.1f}",
+                    delta_color="off",
+                    help="Change in the 7 day mean from the 90 day baseline",
+                )
         plot_dual_axis(
             shared_x="date", line_y="resting_heart_rate", bar_y="sleep_hours", df=vitals
         )
+        heart_rate_path = config["transform"]["heart_rate"]["output_path"]
+        if os.path.exists(heart_rate_path):
+            # Hourly rollups of the intraday readings
+            heart_rate = load_hourly_heart_rate(heart_rate_path)
+            plot_dual_axis(
+                shared_x="date", line_y="bpm_mean", bar_y="cardio_seconds", df=heart_rate
+            )
 
 
 if __name__ == "__main__":
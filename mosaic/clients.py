@@ -0,0 +1,32 @@
+from threading import Lock
+import hashlib
+import json
+
+
+def creds_key(creds):
+    return hashlib.sha1(json.dumps(creds, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ClientRegistry:
+    """Builds each provider's API client once and hands the same one to every extract, so accounts and
+    endpoints share its connection pool. Lives for the whole process, so the background refresher
+    keeps warm connections between runs. A client is rebuilt when its provider's creds change, for
+    example after a token refresh."""
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = Lock()
+
+    def get(self, provider, creds, build):
+        key = creds_key(creds)
+        with self.lock:
+            if provider not in self.clients or self.clients[provider][0] != key:
+                self.clients[provider] = (key, build(creds))
+            return self.clients[provider][1]
+
+    def clear(self):
+        with self.lock:
+            self.clients = {}
+
+
+CLIENTS = ClientRegistry()
@@ -1,66 +1,32 @@
-import os, datetime, json
-import numpy as np
-import pandas as pd
+import argparse, os, datetime, functools, inspect, json
 from mosaic.extract.plaid import extract_plaid
-from mosaic.extract.fitbit import extract_fitbit
+from mosaic.extract.fitbit import extract_fitbit, ID_SCHEME as FITBIT_ID_SCHEME
 from mosaic.extract.splitwise import extract_splitwise
 from mosaic.extract.strava import extract_strava
 from mosaic.transform.skis import transform_skis
-from mosaic.transform.vitals import transform_vitals
-from mosaic.transform.transactions import transform_transactions
+from mosaic.transform.vitals_stats import history_files, transform_vitals_stats
+from mosaic.transform.heart_rate import transform_heart_rate
+from mosaic.transform import reconcile, rules
+from mosaic.transform.transactions import (
+    transform_transactions,
+    QUERY_PATHS as TRANSACTIONS_QUERY_PATHS,
+)
 from mosaic.utils import lookup_yaml, convert_string_to_date
 from mosaic.credentials import AccessTokenManager, CredsFile
+from mosaic.fingerprint import TransformFingerprint
+from mosaic.scheduler import StageGraph
+from mosaic.storage import OutputFile
+from mosaic.throttle import log_throttle_metrics, throttle_snapshots
 import logging
 
 
 # TODO
-# - Migrate all dates to numpy datetime64
 # - Set up the start and end for transform steps
-# - Set up last run to enable ETL running every hour
 
 
 CONFIG_PATH, CREDS_PATH = "etl_config.yml", "creds.yml"
 
 
-class OutputFile:
-    def __init__(self, path, schema):
-        self.path = path
-        self._directory_path = self._get_directory_path()
-        self.schema = schema
-
-    def _get_directory_path(self):
-        return os.path.dirname(self.path)
-
-    def _directory_exists(self):
-        return os.path.exists(self._directory_path)
-
-    def _create_directory(self):
-        os.makedirs(self._directory_path)
-
-    def create_path(self):
-        if not self._directory_exists():
-            self._create_directory()
-
-    def exists(self):
-        return os.path.exists(self.path)
-
-    def get_df(self):
-        return self.schema.conform(pd.read_csv(self.path))
-
-    def get_latest_row_date(self, date_col="date"):
-        df = self.get_df()
-        latest_row_date = np.datetime64(df[date_col].max().date())
-        return latest_row_date
-
-
-class Schema:
-    def __init__(self, schema):
-        self.schema = schema
-
-    def conform(self, df):
-        return df.astype(dtype=self.schema)[self.schema.keys()]
-
-
 class LastRun:
     def __init__(self):
         self._file_path =  "/tmp/last_etl_run.json"
@@ -69,23 +35,48 @@ class LastRun:
     def _today(self):
         return str(datetime.date.today())
 
-    def read(self):
+    def _read_key(self, key):
         if os.path.exists(self._file_path):
             with open(self._file_path, 'r') as f:
-                return json.load(f).get('last_run_date')
+                return json.load(f).get(key)
         else:
             return None
 
+    def read(self):
+        return self._read_key('last_run_date')
+
+    def read_time(self):
+        last_run_at = self._read_key('last_run_at')
+        if last_run_at is None:
+            return None
+        return datetime.datetime.fromisoformat(last_run_at)
+
     def update(self):
         with open(self._file_path, 'w') as f:
-            json.dump({'last_run_date': self._today}, f)
+            json.dump(
+                {
+                    'last_run_date': self._today,
+                    'last_run_at': datetime.datetime.now().isoformat(),
+                },
+                f,
+            )
 
     def was_today(self):
         return self.read() == self._today
 
     def was_this_hour(self):
         "Checks if the last read of the ETL was within the present hour"
-        return  # boolean value
+        last_run_time = self.read_time()
+        if last_run_time is None:
+            return False
+        this_hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        return last_run_time >= this_hour
+
+    def was_within(self, minutes):
+        last_run_time = self.read_time()
+        if last_run_time is None:
+            return False
+        return datetime.datetime.now() - last_run_time < datetime.timedelta(minutes=minutes)
 
 
 def convert_all_dates(
@@ -114,83 +105,221 @@ def create_path_to_file_if_not_exists(full_path):
         os.makedirs(directory_path)
 
 
-def dedup_combined_data(existing_df, incremental_df):
-    df = pd.concat((existing_df, incremental_df), axis=0)
-    total_rows = len(df)
-    df = df.drop_duplicates(subset="id")
-    logging.info(
-        f"Incremental extract fetched {len(incremental_df)} rows for a total of {len(df)} after dropping {total_rows - len(df)} duplicates"
-    )
-    return df
+EXTRACTS = {
+    "strava": extract_strava,
+    "fitbit": extract_fitbit,
+    "splitwise": extract_splitwise,
+    "plaid": extract_plaid,
+}
+# How each source derives row ids, for sources whose scheme has changed since outputs were first written
+ID_SCHEMES = {
+    "fitbit": FITBIT_ID_SCHEME,
+}
 
 
-def run_etl(config_path=CONFIG_PATH, creds_path=CREDS_PATH):
-    last_run = LastRun()
-    # if last_run.was_today():
-    #     return
-    config = lookup_yaml(config_path)
-    creds_file = CredsFile(CREDS_PATH)
+def extract_stage_name(source, endpoint):
+    return f"extract {source} {endpoint}"
 
-    # Extracts
-    convert_all_dates(config)
-    sources = [
-        "strava",
-        "fitbit",
-        "splitwise",
-        "plaid",
-    ]
-    extract_steps = [extract_strava, extract_fitbit, extract_splitwise, extract_plaid]
-    for source, extract in zip(sources, extract_steps):
+
+def extract_endpoint(extract, creds, source, endpoint, source_config, endpoint_config):
+    start_date, end_date = source_config["start_date"], source_config["end_date"]
+    logging.info(f"Extracting {source}  {endpoint} between {start_date} and {end_date}.")
+    output_file = OutputFile.from_config(endpoint_config)
+    output_file.create_path()
+    # Options like Plaid's cursor based sync are passed straight through to the extract
+    extract = functools.partial(
+        extract, output_file=output_file, **endpoint_config.get("extract_options", {})
+    )
+    id_scheme = ID_SCHEMES.get(source)
+    if output_file.exists() and output_file.get_id_scheme() != id_scheme:
+        # Merging by id would append a second copy of every row already stored under the old ids
+        logging.info(
+            f"Output file's ids predate the {id_scheme} scheme. Running full extract to rebuild it."
+        )
+        incremental = False
+    else:
+        incremental = output_file.exists()
+    if incremental:
+        logging.info(f"Output file found. Running incremental extract.")
+        # The watermark comes from the output's metadata sidecar rather than a read of the data
+        latest_row_date = output_file.get_latest_row_date()
+        if latest_row_date is not None:
+            start_date = max(latest_row_date, start_date)
+        # Streaming extracts write to the output as they fetch and return nothing
+        incremental_df = extract(creds, start_date, end_date, endpoint)
+        if incremental_df is not None and not incremental_df.empty:
+            output_file.merge(incremental_df)
+    else:
+        logging.info(f"Running full extract.")
+        output_file.cursor.reset()
+        df = extract(creds, start_date, end_date, endpoint)
+        if df is not None:
+            output_file.write(df)
+            logging.info(f"Full extract fetched {len(df)} rows since {start_date}")
+    output_file.set_id_scheme(id_scheme)
+    output_file.cursor.commit()
+    output_file.checkpoints.clear()
+
+
+def add_extract_stages(graph, config, creds_file):
+    for source, extract in EXTRACTS.items():
+        # Refreshing tokens can open a browser and rewrites the creds file, so it happens up front and one source at a time
         creds = get_refreshed_creds(source, creds_file)
         source_config = config["extract"][source]
         for endpoint, endpoint_config in source_config["endpoints"].items():
-            start_date, end_date = source_config["start_date"], source_config["end_date"]
-            logging.info(f"Extracting {source}  {endpoint} between {start_date} and {end_date}.")
-            schema = Schema(endpoint_config["output_schema"])
-            output_file = OutputFile(endpoint_config["output_path"], schema)
-            output_file.create_path()
-            if output_file.exists():
-                logging.info(f"Output file found. Running incremental extract.")
-                start_date = max(output_file.get_latest_row_date(), start_date)
-                incremental_df = extract(creds, output_file.get_latest_row_date(), end_date, endpoint)
-                if not incremental_df.empty:
-                    df = dedup_combined_data(
-                        schema.conform(output_file.get_df()), schema.conform(incremental_df)
-                    )
-                elif incremental_df.empty:
-                    df = schema.conform(output_file.get_df())
-            elif not output_file.exists():
-                logging.info(f"No output file found. Running full extract.")
-                df = schema.conform(extract(creds, start_date, end_date, endpoint))
-                logging.info(f"Full extract fetched {len(df)} rows since {start_date}")
-            df.to_csv(output_file.path, index=False)
-
-    # Transforms
-    create_path_to_file_if_not_exists(config["transform"]["vitals"]["output_path"])
-    endpoints = config["extract"]["fitbit"]["endpoints"]
-    transform_vitals(
-        extract_fitbit_hearts_path=endpoints["activities/heart"]["output_path"],
-        extract_fitbit_sleeps_path=endpoints["sleep"]["output_path"],
-        extract_fitbit_weights_path=endpoints["body/weight"]["output_path"],
-        extract_fitbit_bmis_path=endpoints["body/bmi"]["output_path"],
-        **config["transform"]["vitals"],
+            graph.add(
+                extract_stage_name(source, endpoint),
+                functools.partial(
+                    extract_endpoint,
+                    extract,
+                    creds,
+                    source,
+                    endpoint,
+                    source_config,
+                    endpoint_config,
+                ),
+            )
+
+
+def add_transform_stage(
+    graph,
+    name,
+    transform,
+    inputs,
+    output_path,
+    force,
+    code_paths=(),
+    other_output_paths=(),
+    **kwargs,
+):
+    """Adds a transform that waits on the extracts of its inputs, keyed by (source, endpoint), and
+    is skipped when its inputs, config and code haven't changed since its outputs were last written"""
+
+    def run():
+        create_path_to_file_if_not_exists(output_path)
+        fingerprint = TransformFingerprint(
+            output_path,
+            [OutputFile.from_config(c) for c in inputs.values()],
+            {"output_path": output_path, **kwargs},
+            [inspect.getsourcefile(transform), *code_paths],
+            other_output_paths,
+        )
+        current_fingerprint = fingerprint.compute()
+        if not force and fingerprint.is_current(current_fingerprint):
+            logging.info(f"Skipping transform {name} since its inputs haven't changed")
+            return
+        transform(output_path=output_path, **kwargs)
+        fingerprint.update(current_fingerprint)
+
+    depends_on = [extract_stage_name(*source_endpoint) for source_endpoint in inputs]
+    graph.add(f"transform {name}", run, depends_on=depends_on)
+
+
+def endpoint_configs(config, source, endpoints=None):
+    source_endpoints = config["extract"][source]["endpoints"]
+    if endpoints is None:
+        endpoints = source_endpoints.keys()
+    return {(source, e): source_endpoints[e] for e in endpoints}
+
+
+def add_transform_stages(graph, config, force=False):
+    fitbit_endpoints = config["extract"]["fitbit"]["endpoints"]
+    vitals_endpoints = ["activities/heart", "sleep", "body/weight", "body/bmi"]
+    # Intraday heart rate is opt in, so only its own transform waits on it
+    if "activities/heart/intraday" in fitbit_endpoints:
+        add_transform_stage(
+            graph,
+            "heart_rate",
+            transform_heart_rate,
+            endpoint_configs(config, "fitbit", ["activities/heart/intraday"]),
+            force=force,
+            other_output_paths=[config["transform"]["heart_rate"]["zones_output_path"]],
+            extract_fitbit_endpoints=fitbit_endpoints,
+            **config["transform"]["heart_rate"],
+        )
+    add_transform_stage(
+        graph,
+        "vitals_stats",
+        transform_vitals_stats,
+        endpoint_configs(config, "fitbit", vitals_endpoints),
+        force=force,
+        other_output_paths=history_files(config["transform"]["vitals_stats"]["history_path"]),
+        extract_fitbit_endpoints=fitbit_endpoints,
+        **config["transform"]["vitals_stats"],
     )
-    create_path_to_file_if_not_exists(config["transform"]["skis"]["output_path"])
-    transform_skis(
-        extract_strava_path=config["extract"]["strava"]["endpoints"]["activities"][
-            "output_path"
-        ],
+    add_transform_stage(
+        graph,
+        "skis",
+        transform_skis,
+        endpoint_configs(config, "strava", ["activities"]),
+        force=force,
+        extract_strava_endpoint=config["extract"]["strava"]["endpoints"]["activities"],
         **config["transform"]["skis"],
     )
-    create_path_to_file_if_not_exists(
-        config["transform"]["transactions"]["output_path"]
-    )
-    transform_transactions(
+    add_transform_stage(
+        graph,
+        "transactions",
+        transform_transactions,
+        {
+            **endpoint_configs(config, "plaid"),
+            **endpoint_configs(config, "splitwise", ["expenses"]),
+        },
+        force=force,
+        code_paths=[
+            *TRANSACTIONS_QUERY_PATHS,
+            inspect.getsourcefile(reconcile),
+            inspect.getsourcefile(rules),
+            config["transform"]["transactions"].get("rules_path", rules.RULES_PATH),
+        ],
         extract_plaid_endpoints=config["extract"]["plaid"]["endpoints"],
-        extract_splitwise_path=config["extract"]["splitwise"]["endpoints"]["expenses"][
-            "output_path"
+        extract_splitwise_endpoint=config["extract"]["splitwise"]["endpoints"][
+            "expenses"
         ],
         **config["transform"]["transactions"],
     )
 
+
+def run_etl(config_path=CONFIG_PATH, creds_path=CREDS_PATH, force=False):
+    last_run = LastRun()
+    # if last_run.was_today():
+    #     return
+    config = lookup_yaml(config_path)
+    creds_file = CredsFile(creds_path)
+    convert_all_dates(config)
+
+    graph = StageGraph(max_workers=config.get("max_workers", 4))
+    add_extract_stages(graph, config, creds_file)
+    add_transform_stages(graph, config, force)
+    throttle_metrics_before = throttle_snapshots()
+    try:
+        graph.run()
+    finally:
+        log_throttle_metrics(since=throttle_metrics_before)
+
     last_run.update()
+
+
+def compact_outputs(config_path=CONFIG_PATH):
+    config = lookup_yaml(config_path)
+    for source_config in config["extract"].values():
+        for endpoint_config in source_config["endpoints"].values():
+            OutputFile.from_config(endpoint_config).compact()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Mosaic ETL")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Merge the part files of partitioned extracts and drop superseded rows instead of running the ETL",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun every transform even if its inputs haven't changed",
+    )
+    args = parser.parse_args()
+    if args.compact:
+        compact_outputs()
+    else:
+        run_etl(force=args.force)
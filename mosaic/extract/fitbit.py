@@ -1,14 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging as getLogger
 import fitbit
+from fitbit.exceptions import HTTPServerError
 import numpy as np
 import pandas as pd
+from mosaic.clients import CLIENTS
+from mosaic.extract.fitbit_intraday import extract_heart_intraday
+from mosaic.throttle import Throttle, TRANSIENT, classify_error
+from mosaic.utils import stable_row_ids
 
 
 getLogger.getLogger().setLevel(getLogger.DEBUG)
 
 
-def generate_deterministic_id_vector(df):
-    return df.astype(str).agg('_'.join, axis=1).map(hash)
+def classify_fitbit_error(error):
+    # The fitbit client raises its own exceptions without the response's status
+    if isinstance(error, HTTPServerError):
+        return TRANSIENT
+    return classify_error(error)
+
+
+FITBIT_THROTTLE = Throttle(
+    "fitbit", quotas=[(150, 60 * 60)], classify=classify_fitbit_error
+)
+
+
+# Columns that identify a row, so a day whose values Fitbit revises keeps its id and is replaced on merge
+ID_COLUMNS = {"sleep": ["startTime"]}
+DEFAULT_ID_COLUMNS = ["dateTime"]
+# Recorded in each output's metadata. Outputs written under another scheme, like the salted hashes
+# used before stable_row_ids, can never match new ids and are rebuilt by a full extract.
+ID_SCHEME = "stable_row_ids"
 
 
 def unload_simple_json(data, d=None):
@@ -73,36 +95,83 @@ def hit_api(client, resource, start_date, end_date):
     client.time_series(resource, base_date=start_date, end_date=end_date)
 
 
-def extract_fitbit(
-    creds,
-    start_date,
-    end_date,
-    endpoint,
-):
-    client = fitbit.Fitbit(
+def get_client(creds):
+    return fitbit.Fitbit(
         client_id=creds["client_id"],
         client_secret=creds["client_secret"],
         access_token=creds["access_token"],
         refresh_token=creds["refresh_token"],
         expires_at=creds["expires_at"],
     )
-    getLogger.debug(endpoint)
-    working_start_date = start_date
-    working_end_date = min(working_start_date + timedelta(days=100), end_date)
-    dfs = []
-    more_data_to_extract = True
-    while more_data_to_extract:
-        getLogger.debug(working_start_date)
-        getLogger.debug(working_end_date)
-        raw_json_extract = client.time_series(
-            endpoint, base_date=working_start_date.item(), end_date=working_end_date.item()
+
+
+def plan_windows(start_date, end_date, window_days=100):
+    """Splits the range into the consecutive windows Fitbit will serve in one time series request"""
+    windows = []
+    window_start_date = start_date
+    while window_start_date <= end_date:
+        window_end_date = min(window_start_date + timedelta(days=window_days), end_date)
+        windows.append((window_start_date, window_end_date))
+        window_start_date = window_end_date + timedelta(days=1)
+    return windows
+
+
+def fetch_window(
+    client, endpoint, window_start_date, window_end_date, checkpoints=None, is_final=False
+):
+    # The final window may still be filling in, so it's always fetched fresh
+    raw_json_extract = None
+    if checkpoints is not None and not is_final:
+        raw_json_extract = checkpoints.read(window_start_date, window_end_date)
+    if raw_json_extract is None:
+        getLogger.debug(f"Fetching {endpoint} from {window_start_date} to {window_end_date}")
+        raw_json_extract = FITBIT_THROTTLE.call(
+            client.time_series,
+            endpoint,
+            base_date=window_start_date.item(),
+            end_date=window_end_date.item(),
+        )
+        if checkpoints is not None and not is_final:
+            checkpoints.save(window_start_date, window_end_date, raw_json_extract)
+    else:
+        getLogger.debug(f"Resuming {endpoint} from {window_start_date} to {window_end_date}")
+    return unload_fitbit_payload(raw_json_extract, endpoint)
+
+
+def extract_fitbit(
+    creds,
+    start_date,
+    end_date,
+    endpoint,
+    output_file=None,
+    max_concurrent_windows=4,
+    intraday=False,
+    detail_level="1sec",
+    raw_path=None,
+):
+    client = CLIENTS.get("fitbit", creds, get_client)
+    if intraday:
+        # Endpoints like activities/heart/intraday store raw readings under raw_path and stream per
+        # minute rollups into the output
+        return extract_heart_intraday(
+            client, FITBIT_THROTTLE, start_date, end_date, raw_path, output_file, detail_level
+        )
+    checkpoints = output_file.checkpoints if output_file is not None else None
+    windows = plan_windows(start_date, end_date)
+    getLogger.debug(f"Extracting {endpoint} in {len(windows)} windows")
+    if not windows:
+        return pd.DataFrame()
+    # Every endpoint's windows go through FITBIT_THROTTLE, so concurrent endpoints interleave under one hourly quota
+    with ThreadPoolExecutor(max_workers=max_concurrent_windows) as executor:
+        dfs = list(
+            executor.map(
+                lambda window: fetch_window(
+                    client, endpoint, *window, checkpoints, window[1] == end_date
+                ),
+                windows,
+            )
         )
-        df = unload_fitbit_payload(raw_json_extract, endpoint)
-        df["id"] = generate_deterministic_id_vector(df)
-        dfs.append(df)
-        more_data_to_extract = working_end_date < end_date
-        working_start_date = working_end_date + timedelta(days=1)
-        working_end_date = min((working_start_date + timedelta(days=100)), end_date)
     df = pd.concat(dfs, axis=0)
+    df["id"] = stable_row_ids(df, ID_COLUMNS.get(endpoint, DEFAULT_ID_COLUMNS))
     df = df.rename(columns={"dateTime": "date", "dateOfSleep": "date"})
     return df
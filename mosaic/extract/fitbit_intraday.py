@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging as getLogger
+import os
+import numpy as np
+import pandas as pd
+
+
+# One heart rate reading, as seconds since the start of its day and beats per minute
+SAMPLE_DTYPE = np.dtype([("offset", "<u4"), ("bpm", "<i2")])
+ZONE_COLUMNS = {
+    "Fat Burn": "fat_burn_seconds",
+    "Cardio": "cardio_seconds",
+    "Peak": "peak_seconds",
+}
+# A reading stands for the time until the next one, but not across gaps where the tracker was off
+MAX_SAMPLE_SECONDS = 60
+
+
+class IntradayStore:
+    """Raw intraday readings kept as one typed .npy file per day, so a day can be memory mapped without
+    parsing, plus a small JSON sidecar with that day's heart rate zones"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _day_path(self, day, extension):
+        return os.path.join(self.path, f"{day}{extension}")
+
+    def has(self, day):
+        return os.path.exists(self._day_path(day, ".npy")) and os.path.exists(
+            self._day_path(day, ".zones.json")
+        )
+
+    def write(self, day, samples, zones):
+        os.makedirs(self.path, exist_ok=True)
+        # Zones are written first so a day only counts as stored once its samples land
+        with open(self._day_path(day, ".zones.json"), "w") as f:
+            json.dump(zones, f)
+        npy_path = self._day_path(day, ".npy")
+        with open(npy_path + ".tmp", "wb") as f:
+            np.save(f, samples)
+        os.replace(npy_path + ".tmp", npy_path)
+
+    def read(self, day):
+        samples = np.load(self._day_path(day, ".npy"), mmap_mode="r")
+        with open(self._day_path(day, ".zones.json"), "r") as f:
+            zones = json.load(f)
+        return samples, zones
+
+
+def parse_intraday_payload(payload):
+    """Turns an intraday activities/heart response into sorted readings and that day's zone ranges"""
+    dataset = payload["activities-heart-intraday"]["dataset"]
+    samples = np.empty(len(dataset), dtype=SAMPLE_DTYPE)
+    if dataset:
+        readings = pd.DataFrame(dataset)
+        samples["offset"] = pd.to_timedelta(readings["time"]).dt.total_seconds()
+        samples["bpm"] = readings["value"]
+        samples.sort(order="offset")
+    summary = payload["activities-heart"][0]["value"] if payload["activities-heart"] else {}
+    zones = [
+        {"name": zone["name"], "min": zone["min"], "max": zone["max"]}
+        for zone in summary.get("heartRateZones", [])
+    ]
+    return samples, zones
+
+
+def minute_rollup(day, samples, zones):
+    """Mean, min and max heart rate and seconds in each zone for every minute with readings"""
+    offsets = samples["offset"].astype("int64")
+    bpm = samples["bpm"].astype("int16")
+    durations = np.minimum(
+        np.diff(offsets, append=offsets[-1] + MAX_SAMPLE_SECONDS), MAX_SAMPLE_SECONDS
+    )
+    df = pd.DataFrame({"minute": offsets // 60, "bpm": bpm})
+    for zone in zones:
+        if zone["name"] in ZONE_COLUMNS:
+            in_zone = (bpm >= zone["min"]) & (bpm < zone["max"])
+            df[ZONE_COLUMNS[zone["name"]]] = np.where(in_zone, durations, 0)
+    for col in ZONE_COLUMNS.values():
+        if col not in df:
+            df[col] = 0
+    rollup = df.groupby("minute").agg(
+        bpm_mean=("bpm", "mean"),
+        bpm_min=("bpm", "min"),
+        bpm_max=("bpm", "max"),
+        samples=("bpm", "size"),
+        **{col: (col, "sum") for col in ZONE_COLUMNS.values()},
+    )
+    rollup.index = np.datetime64(day, "m") + rollup.index.to_numpy().astype("timedelta64[m]")
+    rollup = rollup.rename_axis("date").reset_index()
+    # Epoch minutes are unique and stable, so a reprocessed day replaces its rows on merge
+    rollup["id"] = rollup["date"].to_numpy().astype("datetime64[m]").astype("int64")
+    return rollup
+
+
+def process_day(fetch, store, day, is_final):
+    # Stored days double as checkpoints. The final day may still be filling in, so it's always fetched.
+    if store.has(day) and not is_final:
+        samples, zones = store.read(day)
+    else:
+        samples, zones = parse_intraday_payload(fetch(day))
+        store.write(day, samples, zones)
+    if len(samples) == 0:
+        return None
+    # Only this day's readings are ever held, and just until its minutes are rolled up
+    return minute_rollup(day, samples, zones)
+
+
+def iter_day_rollups(fetch, store, days, max_concurrent_days):
+    """Yields each day's rollup in order, processing max_concurrent_days days at a time"""
+    with ThreadPoolExecutor(max_workers=max_concurrent_days) as executor:
+        for i in range(0, len(days), max_concurrent_days):
+            batch = days[i : i + max_concurrent_days]
+            for rollup in executor.map(
+                lambda day: process_day(fetch, store, day, day == days[-1]), batch
+            ):
+                if rollup is not None:
+                    yield rollup
+
+
+def extract_heart_intraday(
+    client,
+    throttle,
+    start_date,
+    end_date,
+    raw_path,
+    output_file,
+    detail_level="1sec",
+    max_concurrent_days=4,
+):
+    """Stores each day's raw intraday heart rate under raw_path and streams its per minute rollup
+    into output_file"""
+    store = IntradayStore(raw_path)
+
+    def fetch(day):
+        getLogger.debug(f"Fetching intraday heart rate for {day}")
+        return throttle.call(
+            client.intraday_time_series,
+            "activities/heart",
+            base_date=day.item(),
+            detail_level=detail_level,
+        )
+
+    days = np.arange(start_date, end_date + np.timedelta64(1, "D"), dtype="datetime64[D]")
+    # Rollups are written a month at a time, so a backfill holds at most a month of minutes and adds
+    # one part file per month to the output rather than one per day
+    month_rollups = []
+    rolled_up_days = 0
+
+    def write_month():
+        month = pd.concat(month_rollups, ignore_index=True)
+        if output_file.exists():
+            output_file.merge(month)
+        else:
+            output_file.write(month)
+        month_rollups.clear()
+
+    for rollup in iter_day_rollups(fetch, store, days, max_concurrent_days):
+        month = rollup["date"].iloc[0].strftime("%Y-%m")
+        if month_rollups and month != month_rollups[-1]["date"].iloc[0].strftime("%Y-%m"):
+            write_month()
+        month_rollups.append(rollup)
+        rolled_up_days += 1
+    if month_rollups:
+        write_month()
+    if not output_file.exists():
+        output_file.write(
+            output_file.schema.conform(pd.DataFrame(columns=list(output_file.schema.schema)))
+        )
+    getLogger.info(
+        f"Streamed intraday heart rate for {rolled_up_days} of {len(days)} days into {output_file.path}"
+    )
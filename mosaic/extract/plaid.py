@@ -1,17 +1,26 @@
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import logging as getLogger
+import numpy as np
 import pandas as pd
 import plaid
 from plaid.api import plaid_api
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+from plaid.model.transactions_sync_request_options import (
+    TransactionsSyncRequestOptions,
+)
 from plaid.model.item_public_token_exchange_request import (
     ItemPublicTokenExchangeRequest,
 )
-from ratelimit import limits, sleep_and_retry
-import time
+import json
+from mosaic.clients import CLIENTS
+from mosaic.load import cached_on_files
+from mosaic.storage import REMOVED_COL
+from mosaic.throttle import Throttle
 from mosaic.utils import lookup_yaml
 
 
@@ -20,52 +29,59 @@ pd.options.display.max_rows = None
 getLogger.getLogger().setLevel(getLogger.DEBUG)
 
 
-def get_client(client_id, client_secret):
+MAX_CONCURRENT_PAGES = 8
+
+
+def get_client(client_id, client_secret, host=plaid.Environment.Development):
     configuration = plaid.Configuration(
-        host=plaid.Environment.Development,
+        host=host,
         api_key={
             "clientId": client_id,
             "secret": client_secret,
         },
     )
+    # Enough kept alive connections for every page of a concurrent fetch
+    configuration.connection_pool_maxsize = MAX_CONCURRENT_PAGES
     api_client = plaid.ApiClient(configuration)
     client = plaid_api.PlaidApi(api_client)
     return client
 
 
+# Shared by every account's fetcher and syncer so a run's requests draw from one budget
+PLAID_THROTTLE = Throttle("plaid", quotas=[(30, 60)])
+
+
 class TransactionsFetcher:
     def __init__(
         self,
         client,
         access_token,
+        page_size=500,
+        throttle=PLAID_THROTTLE,
     ):
         self.client = client
         self.access_token = access_token
-        self.options = TransactionsGetRequestOptions(
-            include_personal_finance_category=True,
-        )
+        self.page_size = page_size
+        self.throttle = throttle
 
-    @sleep_and_retry
-    @limits(calls=30, period=60)
     def _fetch_request_handler(
         self,
         start_date,
         end_date,
+        offset=0,
     ):
+        # Each page gets its own options since pages are requested concurrently
         request = TransactionsGetRequest(
             access_token=self.access_token,
             start_date=start_date,
             end_date=end_date,
-            options=self.options,
+            options=TransactionsGetRequestOptions(
+                include_personal_finance_category=True,
+                count=self.page_size,
+                offset=offset,
+            ),
         )
-        try:
-            response = self.client.transactions_get(request)
-        # TODO - Improve error handling so that this only sleeps if it's actually a rate limit issue
-        except:
-            getLogger.info(
-                "Hit rate limit unexpectedly. Sleeping a full minute to reset."
-            )
-            time.sleep(60)
+        response = self.throttle.call(self.client.transactions_get, request)
         return response.to_dict()
 
     def fetch(
@@ -73,13 +89,18 @@ class TransactionsFetcher:
         start_date,
         end_date,
     ):
-        transactions = []
-        still_more_transactions = True
-        while still_more_transactions:
-            self.options.offset = len(transactions)
-            response = self._fetch_request_handler(start_date, end_date)
-            transactions += response["transactions"]
-            still_more_transactions = len(transactions) < response["total_transactions"]
+        # The first page reports the total, so the remaining offsets can all be requested at once
+        response = self._fetch_request_handler(start_date, end_date)
+        transactions = response["transactions"]
+        offsets = range(len(transactions), response["total_transactions"], self.page_size)
+        if len(transactions) and len(offsets):
+            with ThreadPoolExecutor(max_workers=min(len(offsets), MAX_CONCURRENT_PAGES)) as executor:
+                pages = executor.map(
+                    lambda offset: self._fetch_request_handler(start_date, end_date, offset),
+                    offsets,
+                )
+                for page in pages:
+                    transactions += page["transactions"]
         # TODO - This could be a test
         getLogger.debug(
             f"Fetched {len(transactions)} transactions vs expected {response['total_transactions']}"
@@ -87,101 +108,224 @@ class TransactionsFetcher:
         return transactions
 
 
+class TransactionsSyncer:
+    """Pages through /transactions/sync from a saved cursor, returning only what changed since then"""
+
+    def __init__(
+        self, client, access_token, page_size=500, record_path=None, throttle=PLAID_THROTTLE
+    ):
+        self.client = client
+        self.access_token = access_token
+        self.page_size = page_size
+        self.throttle = throttle
+        self.options = TransactionsSyncRequestOptions(
+            include_personal_finance_category=True,
+        )
+        # Recorded pages can be replayed offline by tests/plaid_replay.py
+        self.record_path = record_path
+        self.recorded_pages = []
+
+    def _sync_request_handler(self, cursor):
+        request = TransactionsSyncRequest(
+            access_token=self.access_token,
+            count=self.page_size,
+            options=self.options,
+        )
+        if cursor:
+            request.cursor = cursor
+        response = self.throttle.call(self.client.transactions_sync, request).to_dict()
+        if self.record_path:
+            self.recorded_pages.append(response)
+        return response
+
+    def _sync_pages(self, cursor):
+        added, modified, removed = [], [], []
+        has_more = True
+        while has_more:
+            response = self._sync_request_handler(cursor)
+            added += response["added"]
+            modified += response["modified"]
+            removed += response["removed"]
+            has_more = response["has_more"]
+            cursor = response["next_cursor"]
+        return added, modified, removed, cursor
+
+    def sync(self, cursor=None):
+        while True:
+            self.recorded_pages = []
+            try:
+                added, modified, removed, next_cursor = self._sync_pages(cursor)
+                break
+            except plaid.ApiException as e:
+                if "TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION" not in str(e.body):
+                    raise
+                # Plaid asks for the whole update to be restarted from the original cursor
+                getLogger.info("Transactions changed while paging. Restarting the sync.")
+        if self.record_path:
+            with open(self.record_path, "w") as f:
+                json.dump(self.recorded_pages, f, default=str, indent=2)
+        getLogger.info(
+            f"Synced {len(added)} added, {len(modified)} modified and {len(removed)} removed transactions"
+        )
+        return added + modified, [r["transaction_id"] for r in removed], next_cursor
+
+
 class TransactionCategorizer:
+    """Rules compiled into lookups from each field value to the rank, in file order, of the first
+    category listing it. Fields are tried in field_lookup_order and the best ranked match within a
+    field wins, the same precedence as walking every category's rules in order."""
+
     def __init__(self, categorization_rules):
         self.categorization_rules = categorization_rules
+        self.categories = list(categorization_rules.keys())
         self.field_lookup_order = [
             "transaction_id",
             "name",
             "personal_finance_category",
             "category",
         ]
+        self.lookups = self._compile(categorization_rules)
+
+    @staticmethod
+    def _rule_values(rule):
+        # A lone string is a single allowed value rather than a list of them
+        if rule is None:
+            return []
+        elif isinstance(rule, str):
+            return [rule]
+        return rule
+
+    def _compile(self, categorization_rules):
+        lookups = {
+            "transaction_id": {},
+            "name": {},
+            "personal_finance_category": {"detailed": {}, "primary": {}},
+            "category": {},
+        }
+        for rank, rules in enumerate(categorization_rules.values()):
+            plaid_rules = rules["plaid"]
+            for field in ["transaction_id", "name"]:
+                for value in self._rule_values(plaid_rules[field]):
+                    lookups[field].setdefault(value, rank)
+            personal_finance_rule = plaid_rules["personal_finance_category"] or {}
+            for specificity, rule in personal_finance_rule.items():
+                for value in self._rule_values(rule):
+                    lookups["personal_finance_category"][specificity].setdefault(
+                        value, rank
+                    )
+            category_rule = plaid_rules["category"] or {}
+            for level, rule in category_rule.items():
+                level_lookup = lookups["category"].setdefault(int(level), {})
+                for value in self._rule_values(rule):
+                    level_lookup.setdefault(value, rank)
+        return lookups
+
+    def _sublookups(self, field):
+        """Pairs of a lookup and how to pull its key out of the field's value"""
+        if field == "personal_finance_category":
+            return [
+                (lookup, specificity)
+                for specificity, lookup in self.lookups[field].items()
+            ]
+        elif field == "category":
+            return [(lookup, level) for level, lookup in self.lookups[field].items()]
+        return [(self.lookups[field], None)]
 
-    def _matching_personal_finance_category(self, rule, lookup):
-        getLogger.debug("        PERSONAL FINANCE LOOKUP")
-        for specificity in ["detailed", "primary"]:
-            getLogger.debug(f"        SUBRULE {specificity}:   {rule[specificity]}")
-            getLogger.debug(f"        SUBLOOKUP {specificity}: {lookup[specificity]}")
-            if rule[specificity] is None:
-                continue
-            elif lookup[specificity] in rule[specificity]:
-                return True
-        return False
-
-    def _matching_category(self, rule, lookup):
-        start = len(lookup) - 1
-        stop = 0 - 1
-        step = -1
-        step_backwards_through_subcategories = range(start, stop, step)
-        for i in step_backwards_through_subcategories:
-            if rule[i] is None:
-                continue
-            elif lookup[i] in rule[i]:
-                return True
-        return False
+    def _rank(self, field, value):
+        ranks = []
+        for lookup, key in self._sublookups(field):
+            if key is None:
+                ranks.append(lookup.get(value))
+            elif isinstance(value, dict):
+                ranks.append(lookup.get(value.get(key)))
+            elif isinstance(value, list) and key < len(value):
+                ranks.append(lookup.get(value[key]))
+        ranks = [rank for rank in ranks if rank is not None]
+        return min(ranks) if ranks else None
 
     def categorize(self, transaction):
-        getLogger.debug(transaction)
         for field in self.field_lookup_order:
-            getLogger.debug(f"FIELD: {field}")
-            for category, rules in self.categorization_rules.items():
-                rule = rules["plaid"][field]
-                lookup = transaction[field]
-                getLogger.debug(f"    CATEGORY:  {category}")
-                getLogger.debug(f"    RULE:    {rule}")
-                getLogger.debug(f"    LOOKUP:  {lookup}")
-                if rule is None:
-                    continue
-                elif (
-                    field == "personal_finance_category"
-                    and self._matching_personal_finance_category(rule, lookup)
-                ):
-                    return category
-                elif field == "category" and self._matching_category(rule, lookup):
-                    return category
-                elif (
-                    field not in ["personal_finance_category", "category"]
-                    and lookup in rule
-                ):
-                    return category
+            rank = self._rank(field, transaction[field])
+            if rank is not None:
+                return self.categories[rank]
         return None
 
+    def _rank_vector(self, values, field):
+        ranks = pd.Series(np.nan, index=values.index)
+        for lookup, key in self._sublookups(field):
+            keys = values if key is None else values.str.get(key)
+            ranks = np.fmin(ranks, keys.map(lookup))
+        return ranks
+
+    def categorize_frame(self, df):
+        """Labels every transaction in a dataframe of Plaid transactions at once"""
+        ranks = pd.Series(np.nan, index=df.index)
+        for field in self.field_lookup_order:
+            ranks = ranks.fillna(self._rank_vector(df[field], field))
+        categories = ranks.map(dict(enumerate(self.categories)))
+        return categories.astype(object).where(categories.notna(), None)
+
+
+@cached_on_files
+def load_categorizer(path):
+    # Compiled once and shared by every account until the rules file changes
+    return TransactionCategorizer(lookup_yaml(path))
+
 
 def extract_plaid(
     creds,
     start_date,
     end_date,
     endpoint,
+    output_file=None,
+    sync=False,
+    sync_record_path=None,
 ):
-    client = get_client(creds["client_id"], creds["client_secret"])
+    # Every account shares one client, and with it one connection pool
+    client = CLIENTS.get(
+        "plaid",
+        {
+            "client_id": creds["client_id"],
+            "client_secret": creds["client_secret"],
+            "host": creds.get("host", plaid.Environment.Development),
+        },
+        lambda client_creds: get_client(**client_creds),
+    )
     access_token = creds[endpoint]["access_token"]
-    transactions_fetcher = TransactionsFetcher(client, access_token)
     start_date, end_date = start_date.item(), end_date.item()
-    transactions = transactions_fetcher.fetch(start_date, end_date)
-
-    categorization_rules = lookup_yaml("transaction_categories.yml")
-    transaction_categorizer = TransactionCategorizer(categorization_rules)
-    tailored_categories = []
-    for transaction in transactions:
-        cat = transaction_categorizer.categorize(transaction)
-        tailored_categories.append(cat)
+    removed_ids = []
+    if sync:
+        # The sync feed decides what's new, so the date window doesn't apply
+        transactions_syncer = TransactionsSyncer(
+            client, access_token, record_path=sync_record_path
+        )
+        transactions, removed_ids, next_cursor = transactions_syncer.sync(
+            output_file.cursor.read()
+        )
+        output_file.cursor.stage(next_cursor)
+    else:
+        transactions_fetcher = TransactionsFetcher(client, access_token)
+        transactions = transactions_fetcher.fetch(start_date, end_date)
 
     # Build dataframe
     df = pd.DataFrame(transactions)
     if df.empty:
         getLogger.info(f"No transactions received. Returning blank dataframe")
-        return df
-
-    df["account"] = endpoint
-    df["raw_category"] = df["category"]
-    df["category"] = tailored_categories
-    df = df.rename(columns={'transaction_id': 'id'})
+    else:
+        transaction_categorizer = load_categorizer("transaction_categories.yml")
+        df["account"] = endpoint
+        df["raw_category"] = df["category"]
+        df["category"] = transaction_categorizer.categorize_frame(df)
+        df = df.rename(columns={'transaction_id': 'id'})
 
-    # Outputs for debugging
-    getLogger.info(
-        f"{endpoint} transaction extract for {start_date} till {end_date} complete"
-    )
-    getLogger.debug(
-        f"""{endpoint} earliest and latest transaction dates: {df["date"].min()}, {df["date"].max()}"""
-    )
+        # Outputs for debugging
+        getLogger.info(
+            f"{endpoint} transaction extract for {start_date} till {end_date} complete"
+        )
+        getLogger.debug(
+            f"""{endpoint} earliest and latest transaction dates: {df["date"].min()}, {df["date"].max()}"""
+        )
+    if removed_ids:
+        removed = pd.DataFrame({"id": removed_ids, REMOVED_COL: True})
+        df = pd.concat((df, removed), axis=0, ignore_index=True)
     return df
@@ -1,13 +1,22 @@
 from datetime import datetime
+from types import SimpleNamespace
 import logging as getLogger
+import time
+import numpy as np
 import pandas as pd
 import requests
 from splitwise import Splitwise
+from mosaic.clients import CLIENTS
+from mosaic.storage import REMOVED_COL
+from mosaic.throttle import Throttle
 from mosaic.utils import lookup_yaml
 
 
 getLogger.getLogger().setLevel(getLogger.INFO)
 
+# Splitwise doesn't publish its limits, so this stays well clear of them
+SPLITWISE_THROTTLE = Throttle("splitwise", quotas=[(30, 60)])
+
 
 def find_splitwise_object(search_id, splitwise_objects):
     for splitwise_object in splitwise_objects:
@@ -23,62 +32,163 @@ def map_category(category_rules, expense):
             return category
 
 
+def build_category_lookup(category_rules):
+    """Maps each Splitwise category name to the first rule category listing it, as map_category would"""
+    lookup = {}
+    for category, rule in category_rules.items():
+        for splitwise_category in rule["splitwise"]["category"] or []:
+            lookup.setdefault(splitwise_category, category)
+    return lookup
+
+
+def unpack_expenses(expenses, my_user_id, group_names, category_lookup):
+    """Unpacks expenses straight into columns with dictionary lookups, so the pass is linear in expenses.
+    Returns the frame and the ids of deleted expenses."""
+    columns = {
+        col: []
+        for col in [
+            "id",
+            "date",
+            "description",
+            "is_payment",
+            "cost",
+            "category",
+            "user_names",
+            "net_balance",
+            "paid_share",
+            "owed_share",
+            "group_id",
+            "group_name",
+        ]
+    }
+    removed_ids = []
+    for expense in expenses:
+        if expense.deleted_at is not None:
+            removed_ids.append(int(expense.id))
+            continue
+        columns["id"].append(int(expense.id))
+        columns["date"].append(expense.date)
+        columns["description"].append(str(expense.description))
+        columns["is_payment"].append(bool(expense.payment))
+        columns["cost"].append(float(expense.cost))
+        columns["category"].append(str(category_lookup.get(expense.category.name)))
+        columns["user_names"].append([user.first_name for user in expense.users])
+        user = next((user for user in expense.users if user.id == my_user_id), None)
+        columns["net_balance"].append(None if user is None else float(user.net_balance))
+        columns["paid_share"].append(None if user is None else float(user.paid_share))
+        columns["owed_share"].append(None if user is None else float(user.owed_share))
+        group_name = group_names.get(expense.group_id)
+        columns["group_id"].append(None if group_name is None else expense.group_id)
+        columns["group_name"].append(group_name)
+    df = pd.DataFrame(columns)
+    df["date"] = pd.to_datetime(df["date"], utc=True).dt.tz_localize(None).dt.normalize()
+    return df, removed_ids
+
+
+def get_client(creds):
+    # https://splitwise.readthedocs.io/en/latest/user/authenticate.html#api-key
+    return Splitwise(
+        consumer_key=creds["client_id"],
+        consumer_secret=creds["client_secret"],
+        oauth2_access_token={"access_token": creds["access_token"]},
+    )
+
+
 def extract_splitwise(
     creds,
     start_date,
     end_date,
     endpoint, # For compatability with other extract steps coordinated by etl
+    output_file=None,
+    full_resync=False,
 ):
-    # https://splitwise.readthedocs.io/en/latest/user/authenticate.html#api-key
-    client = Splitwise(
-        consumer_key=creds["client_id"],
-        consumer_secret=creds["client_secret"],
-        oauth2_access_token={"access_token": creds["access_token"]},
-    )
-    my_user_id = client.getCurrentUser().id
-    expenses = client.getExpenses(limit=False)
-    groups = client.getGroups()
-    unpacked_expenses = []
-    rules = lookup_yaml("transaction_categories.yml")
-    splitwise_categories = {}
-    for category, rule in rules.items():
-        splitwise_categories[category] = rule["splitwise"]["category"]
-    for expense in expenses:
-        if expense.deleted_at is not None:
-            continue
-        unpacked_expense = {
-            "id": int(expense.id),
-            "date": pd.to_datetime(expense.date).date(),
-            "description": str(expense.description),
-            "is_payment": bool(expense.payment),
-            "cost": float(expense.cost),
-            "category": str(map_category(rules, expense.category.name)),
-            "user_names": [user.first_name for user in expense.users],
-        }
-
-        user = find_splitwise_object(my_user_id, expense.users)
-        if user is None:
-            for k in [
-                "net_balance",
-                "paid_share",
-                "owed_share",
-            ]:
-                unpacked_expense[k] = None
-        else:
-            unpacked_expense["net_balance"] = float(user.net_balance)
-            unpacked_expense["paid_share"] = float(user.paid_share)
-            unpacked_expense["owed_share"] = float(user.owed_share)
-
-        group = find_splitwise_object(expense.group_id, groups)
-        if group is None:
-            for k in ["group_id", "group_name"]:
-                unpacked_expense[k] = None
-        else:
-            unpacked_expense["group_id"] = group.id
-            unpacked_expense["group_name"] = group.name
-        unpacked_expenses.append(unpacked_expense)
-
-    df = pd.DataFrame(unpacked_expenses)
+    client = CLIENTS.get("splitwise", creds, get_client)
+    my_user_id = SPLITWISE_THROTTLE.call(client.getCurrentUser).id
+    # The watermark is when the last successful sync started, so edits made while it ran are picked up next time
+    updated_after = None
+    if output_file is not None and not full_resync:
+        updated_after = output_file.cursor.read()
+    sync_started_at = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    if updated_after is None:
+        getLogger.info("Fetching every Splitwise expense")
+        expenses = SPLITWISE_THROTTLE.call(client.getExpenses, limit=False)
+    else:
+        getLogger.info(f"Fetching Splitwise expenses updated since {updated_after}")
+        expenses = SPLITWISE_THROTTLE.call(
+            client.getExpenses, limit=False, updated_after=updated_after
+        )
+    groups = SPLITWISE_THROTTLE.call(client.getGroups)
+    group_names = {group.id: group.name for group in groups}
+    category_lookup = build_category_lookup(lookup_yaml("transaction_categories.yml"))
+    df, removed_ids = unpack_expenses(expenses, my_user_id, group_names, category_lookup)
     getLogger.info(df.head())
     getLogger.info(df.info())
+    # Deleted expenses are dropped from the output when it's merged
+    if removed_ids:
+        removed = pd.DataFrame({"id": removed_ids, REMOVED_COL: True})
+        df = pd.concat((df, removed), axis=0, ignore_index=True)
+    if output_file is not None:
+        output_file.cursor.stage(sync_started_at)
     return df
+
+
+def benchmark_unpack_expenses(sizes=(12_500, 25_000, 50_000), expenses_per_group=25):
+    """Times unpack_expenses against the per expense scans it replaced on synthetic accounts that gain a
+    group for every few dozen expenses, as ours do"""
+    rng = np.random.default_rng(0)
+    category_rules = lookup_yaml("transaction_categories.yml")
+    splitwise_categories = list(build_category_lookup(category_rules)) + ["Other"]
+    for size in sizes:
+        groups = [
+            SimpleNamespace(id=group_id, name=f"Group {group_id}")
+            for group_id in range(size // expenses_per_group)
+        ]
+        expenses = [
+            SimpleNamespace(
+                id=i,
+                deleted_at=None,
+                date="2023-01-05T12:00:00Z",
+                description=f"Expense {i}",
+                payment=False,
+                cost="12.50",
+                category=SimpleNamespace(
+                    name=splitwise_categories[i % len(splitwise_categories)]
+                ),
+                users=[
+                    SimpleNamespace(
+                        id=user_id,
+                        first_name=f"User {user_id}",
+                        net_balance="1",
+                        paid_share="2",
+                        owed_share="1",
+                    )
+                    for user_id in (1, 2)
+                ],
+                group_id=int(rng.integers(len(groups))),
+            )
+            for i in range(size)
+        ]
+
+        start = time.perf_counter()
+        for expense in expenses:
+            map_category(category_rules, expense.category.name)
+            find_splitwise_object(1, expense.users)
+            find_splitwise_object(expense.group_id, groups)
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        unpack_expenses(
+            expenses,
+            1,
+            {group.id: group.name for group in groups},
+            build_category_lookup(category_rules),
+        )
+        indexed_seconds = time.perf_counter() - start
+        print(
+            f"{size:,} expenses in {len(groups):,} groups: "
+            f"scans {legacy_seconds:.2f}s, indexed {indexed_seconds:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_unpack_expenses()
@@ -1,6 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import numpy as np
 import pandas as pd
 from stravaio import StravaIO
+from mosaic.clients import CLIENTS
+from mosaic.throttle import Throttle
 
 
 logging.basicConfig(
@@ -8,20 +12,95 @@ logging.basicConfig(
     handlers=[logging.FileHandler("debug.log"), logging.StreamHandler()],
 )
 
+STRAVA_THROTTLE = Throttle("strava", quotas=[(100, 15 * 60), (1000, 24 * 60 * 60)])
+
+
+# Strava's largest page
+PAGE_SIZE = 200
+
 
 def extract_to_dataframe(raw_data) -> pd.DataFrame:
     processed_data = [entry.to_dict() for entry in raw_data]
     return pd.DataFrame(processed_data)
 
 
+def to_epoch(date):
+    return int(pd.Timestamp(date).timestamp())
+
+
+def page_to_frame(activities, schema):
+    """Reads just the schema's columns off a page of activity models, skipping to_dict on everything else"""
+    columns = {}
+    for col in schema.schema:
+        if col == "date":
+            continue
+        values = [getattr(activity, col, None) for activity in activities]
+        # Enum-like models such as the activity type serialize the same way to_dict did
+        columns[col] = [v.to_dict() if hasattr(v, "to_dict") else v for v in values]
+    df = pd.DataFrame(columns)
+    local_starts = pd.to_datetime([activity.start_date_local for activity in activities])
+    if local_starts.tz is not None:
+        local_starts = local_starts.tz_localize(None)
+    df["date"] = local_starts.normalize()
+    return schema.conform(df)
+
+
+def fetch_page(client, after, before, page):
+    return STRAVA_THROTTLE.call(
+        client.activities_api.get_logged_in_athlete_activities,
+        before=before,
+        after=after,
+        page=page,
+        per_page=PAGE_SIZE,
+    )
+
+
+def iter_pages(client, after, before, concurrent_pages=1):
+    """Yields pages of activities in order. With concurrent_pages above one, that many pages are
+    requested at a time until one comes back short."""
+    page = 1
+    with ThreadPoolExecutor(max_workers=concurrent_pages) as executor:
+        while True:
+            batch = executor.map(
+                lambda p: fetch_page(client, after, before, p),
+                range(page, page + concurrent_pages),
+            )
+            for activities in batch:
+                if activities:
+                    yield activities
+                if len(activities) < PAGE_SIZE:
+                    return
+            page += concurrent_pages
+
+
 def extract_strava(
     creds,
     start_date,
     end_date,
     endpoint, # For compatability with other extract steps coordinated by etl
+    output_file=None,
+    concurrent_pages=1,
 ):
-    client = StravaIO(creds["access_token"])
-    raw_data = client.get_logged_in_athlete_activities(after=str(start_date))
-    df = extract_to_dataframe(raw_data)
-    df['date'] = df['start_date_local'].dt.date
-    return df
+    client = CLIENTS.get(
+        "strava",
+        {"access_token": creds["access_token"]},
+        lambda client_creds: StravaIO(client_creds["access_token"]),
+    )
+    after, before = to_epoch(start_date), to_epoch(end_date + np.timedelta64(1, "D"))
+    pages = iter_pages(client, after, before, concurrent_pages)
+    if output_file is None:
+        return pd.concat(
+            [extract_to_dataframe(activities) for activities in pages], ignore_index=True
+        )
+    # Each page is written as soon as it arrives, so only one page is ever held and an interrupted run keeps its progress
+    row_count = 0
+    for activities in pages:
+        df = page_to_frame(activities, output_file.schema)
+        if output_file.exists():
+            output_file.merge(df)
+        else:
+            output_file.write(df)
+        row_count += len(df)
+    if not output_file.exists():
+        output_file.write(page_to_frame([], output_file.schema))
+    logging.info(f"Streamed {row_count} Strava activities into {output_file.path}")
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def hash_config(config):
+    # Dates are resolved before hashing so relative windows like "12 weeks ago" count as changed once they move
+    return hashlib.sha1(
+        json.dumps(config, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class TransformFingerprint:
+    """Records what a transform's last output was built from so an unchanged run can be skipped"""
+
+    def __init__(self, output_path, input_files, config, code_paths=(), other_output_paths=()):
+        self.output_path = output_path
+        self.output_paths = [output_path, *other_output_paths]
+        self.path = os.path.splitext(output_path)[0] + ".fingerprint.json"
+        self.input_files = input_files
+        self.config = config
+        self.code_paths = code_paths
+
+    def compute(self):
+        return {
+            "inputs": {
+                input_file.path: input_file.fingerprint()
+                for input_file in self.input_files
+            },
+            "config": hash_config(self.config),
+            "code": {path: hash_file(path) for path in self.code_paths},
+        }
+
+    def read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return json.load(f)
+        else:
+            return None
+
+    def is_current(self, fingerprint):
+        # A run is only skippable if everything it writes is still there
+        return all(os.path.exists(path) for path in self.output_paths) and self.read() == fingerprint
+
+    def update(self, fingerprint):
+        with open(self.path, "w") as f:
+            json.dump(fingerprint, f, indent=2)
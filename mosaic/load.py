@@ -0,0 +1,87 @@
+from threading import Lock
+import functools
+import os
+import pandas as pd
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cached_on_files(func):
+    """Memoizes a function of output paths in memory until the ETL rewrites any of those files"""
+    cache = {}
+    lock = Lock()
+
+    @functools.wraps(func)
+    def wrapper(*paths):
+        signature = tuple(file_signature(path) for path in paths)
+        with lock:
+            if paths in cache and cache[paths][0] == signature:
+                return cache[paths][1]
+        result = func(*paths)
+        with lock:
+            cache[paths] = (signature, result)
+        return result
+
+    return wrapper
+
+
+def downcast(df, max_category_share=0.5):
+    """Shrinks numbers to the smallest dtype that holds them and repetitive strings to categories"""
+    for col in df.select_dtypes("float").columns:
+        df[col] = pd.to_numeric(df[col], downcast="float")
+    for col in df.select_dtypes("integer").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    for col in df.select_dtypes("object").columns:
+        if df[col].nunique() <= max_category_share * len(df):
+            df[col] = df[col].astype("category")
+    return df
+
+
+# Cached frames are shared across reruns, so callers must treat them as read only
+
+
+@cached_on_files
+def load_skis(path):
+    df = pd.read_csv(path, index_col=0, parse_dates=["date"])
+    return downcast(df)
+
+
+@cached_on_files
+def load_daily_skis(path):
+    ski = load_skis(path)
+    ski = ski.groupby("date", as_index=False).agg(
+        {"total_elevation_gain": "sum", "max_speed": "max"}
+    )
+    ski["season_elevation_gain"] = ski["total_elevation_gain"].cumsum().astype(int)
+    return ski
+
+
+@cached_on_files
+def load_transactions(path):
+    df = pd.read_csv(path, parse_dates=["date", "week", "month"])
+    return downcast(df)
+
+
+@cached_on_files
+def load_weekly_variable_spend(path):
+    spend = load_transactions(path)
+    return (
+        spend.loc[spend["is_variable"], ["week", "category", "amount"]]
+        .groupby(["week", "category"], as_index=False, observed=True)
+        .sum()
+    )
+
+
+@cached_on_files
+def load_vitals_stats(path):
+    df = pd.read_csv(path, parse_dates=["date"])
+    return downcast(df).sort_values("date")
+
+
+@cached_on_files
+def load_hourly_heart_rate(path):
+    df = pd.read_csv(path, parse_dates=["date"])
+    return downcast(df)
@@ -0,0 +1,99 @@
+from threading import Event, Lock, Thread
+import logging as getLogger
+import time
+from mosaic.etl import CONFIG_PATH, CREDS_PATH, LastRun, run_etl
+from mosaic.utils import lookup_yaml
+
+
+class BackgroundRefresher(Thread):
+    """Reruns the ETL on an interval so the dashboard only ever reads materialized outputs.
+    Without an interval it refreshes once per clock hour. A failed refresh is retried with
+    exponential backoff, capped at the interval, rather than on the next poll."""
+
+    def __init__(
+        self,
+        interval_minutes=None,
+        poll_seconds=60,
+        config_path=CONFIG_PATH,
+        creds_path=CREDS_PATH,
+        retry_base_minutes=5,
+    ):
+        super().__init__(name="mosaic-refresher", daemon=True)
+        self.interval_minutes = interval_minutes
+        self.poll_seconds = poll_seconds
+        self.retry_base_minutes = retry_base_minutes
+        self.consecutive_failures = 0
+        self.last_failed_at = None
+        self.config_path = config_path
+        self.creds_path = creds_path
+        self.running = Event()
+        self._stop_requested = Event()
+
+    def retry_delay_minutes(self):
+        max_delay = self.interval_minutes if self.interval_minutes is not None else 60
+        return min(max_delay, self.retry_base_minutes * 2 ** (self.consecutive_failures - 1))
+
+    def is_due(self):
+        if self.last_failed_at is not None:
+            # Failures don't update LastRun, so without this a broken endpoint would rerun every poll
+            minutes_since_failure = (time.monotonic() - self.last_failed_at) / 60
+            if minutes_since_failure < self.retry_delay_minutes():
+                return False
+        last_run = LastRun()
+        if self.interval_minutes is None:
+            return not last_run.was_this_hour()
+        return not last_run.was_within(self.interval_minutes)
+
+    def refresh(self):
+        self.running.set()
+        start = time.perf_counter()
+        try:
+            run_etl(self.config_path, self.creds_path)
+            getLogger.info(
+                f"Background refresh finished in {time.perf_counter() - start:.1f} seconds"
+            )
+            self.consecutive_failures = 0
+            self.last_failed_at = None
+        except Exception:
+            # The dashboard keeps serving the last good outputs until a retry succeeds
+            self.consecutive_failures += 1
+            self.last_failed_at = time.monotonic()
+            getLogger.exception(
+                f"Background refresh failed. Retrying in {self.retry_delay_minutes():.0f} minutes."
+            )
+        finally:
+            self.running.clear()
+
+    def run(self):
+        while not self._stop_requested.is_set():
+            if self.is_due():
+                self.refresh()
+            self._stop_requested.wait(self.poll_seconds)
+
+    def stop(self):
+        self._stop_requested.set()
+
+
+_refresher = None
+_refresher_lock = Lock()
+
+
+def start_background_refresher(config_path=CONFIG_PATH, creds_path=CREDS_PATH):
+    """Starts the process-wide refresher if it isn't already running and returns it"""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            config = lookup_yaml(config_path)
+            _refresher = BackgroundRefresher(
+                interval_minutes=config.get("refresh_interval_minutes"),
+                config_path=config_path,
+                creds_path=creds_path,
+            )
+            _refresher.start()
+        return _refresher
+
+
+if __name__ == "__main__":
+    # Standalone daemon for when the dashboard runs somewhere without a long-lived server
+    refresher = start_background_refresher()
+    refresher.join()
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging as getLogger
+import time
+
+
+class Stage:
+    def __init__(self, name, run, depends_on=()):
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+
+
+class StageGraph:
+    """Runs stages on a bounded worker pool, starting each one as soon as the stages it depends on are done"""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def add(self, name, run, depends_on=()):
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is already in the graph")
+        self.stages[name] = Stage(name, run, depends_on)
+        return name
+
+    def _validate(self):
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(
+                        f"Stage {stage.name} depends on unknown stage {dependency}"
+                    )
+
+    def _ready(self, pending, done):
+        return [
+            stage
+            for stage in pending.values()
+            if all(dependency in done for dependency in stage.depends_on)
+        ]
+
+    def _skip_downstream_of_failures(self, pending, failed, skipped):
+        # Stages downstream of a failure can never start
+        newly_skipped = True
+        while newly_skipped:
+            newly_skipped = False
+            for stage in list(pending.values()):
+                if any(d in failed or d in skipped for d in stage.depends_on):
+                    getLogger.warning(
+                        f"Skipping stage {stage.name} because an upstream stage failed"
+                    )
+                    del pending[stage.name]
+                    skipped.add(stage.name)
+                    newly_skipped = True
+
+    def run(self):
+        self._validate()
+        pending, done, failed, skipped = dict(self.stages), set(), {}, set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stage in self._ready(pending, done):
+                    del pending[stage.name]
+                    getLogger.info(f"Starting stage {stage.name}")
+                    future = executor.submit(self._timed, stage)
+                    running[future] = stage
+                self._skip_downstream_of_failures(pending, failed, skipped)
+                if not running:
+                    if pending:
+                        raise ValueError(
+                            f"Stages {list(pending)} have circular dependencies"
+                        )
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(stage.name)
+                    except Exception as e:
+                        getLogger.exception(f"Stage {stage.name} failed")
+                        failed[stage.name] = e
+        if failed:
+            name, error = next(iter(failed.items()))
+            raise RuntimeError(
+                f"{len(failed)} stage(s) failed and {len(skipped)} were skipped, starting with {name}"
+            ) from error
+        return done
+
+    @staticmethod
+    def _timed(stage):
+        start = time.perf_counter()
+        stage.run()
+        getLogger.info(
+            f"Finished stage {stage.name} in {time.perf_counter() - start:.1f} seconds"
+        )
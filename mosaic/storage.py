@@ -0,0 +1,721 @@
+import datetime
+import glob
+import hashlib
+import json
+import logging as getLogger
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+
+class Schema:
+    def __init__(self, schema):
+        self.schema = schema
+
+    def subset(self, columns=None):
+        if columns is None:
+            return self.schema
+        return {k: self.schema[k] for k in columns}
+
+    def conform(self, df, columns=None):
+        schema = self.subset(columns)
+        # Only cast what isn't already typed, which is everything for CSVs and nothing for typed formats
+        mismatched_dtypes = {
+            k: v for k, v in schema.items() if str(df[k].dtype) != str(v)
+        }
+        if mismatched_dtypes:
+            df = df.astype(dtype=mismatched_dtypes)
+        return df[list(schema.keys())]
+
+
+class CsvFormat:
+    """Plain text that can be opened in a spreadsheet, at the cost of reparsing every column on read"""
+
+    extension = ".csv"
+
+    def read(self, path, schema, columns=None):
+        return schema.conform(pd.read_csv(path, usecols=columns), columns)
+
+    def write(self, df, path):
+        df.to_csv(path, index=False)
+
+    def append(self, df, path):
+        df.to_csv(path, mode="a", header=False, index=False)
+
+
+class ParquetFormat:
+    """Columnar files with the schema's dtypes embedded so reads need neither parsing nor casting"""
+
+    extension = ".parquet"
+
+    def read(self, path, schema, columns=None):
+        return pd.read_parquet(path, columns=columns)
+
+    def write(self, df, path):
+        df.to_parquet(path, index=False)
+
+    # Parquet files can't be appended to in place
+    append = None
+
+
+FORMATS = {
+    "csv": CsvFormat(),
+    "parquet": ParquetFormat(),
+}
+
+PARTITION_PERIODS = {
+    "day": "D",
+    "month": "M",
+    "year": "Y",
+}
+
+
+def id_keys(ids):
+    """Integer ids are indexed as is and string ids, like Plaid's, by a stable 64 bit hash"""
+    if pd.api.types.is_integer_dtype(ids):
+        return ids.to_numpy(dtype="int64")
+    return pd.util.hash_pandas_object(ids.astype(str), index=False).to_numpy()
+
+
+def _stringify(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return str(list(value))
+    return str(value)
+
+
+# Stands in for every kind of missing value, so a None from an API and the NaN it reads back as hash alike
+NULL_TOKEN = "\x00null"
+
+
+def row_hashes(df):
+    # Object columns can hold lists, which can't be hashed, so they're compared by their text
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].map(_stringify, na_action="ignore").where(df[col].notna(), NULL_TOKEN)
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def days_since_epoch(dates):
+    return dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").astype("int64")
+
+
+class IdIndex:
+    """Every stored id kept sorted in an .ids.npz file alongside a hash of its row and its date,
+    so incoming rows can be sorted into new, replaced and unchanged without reading the data"""
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = np.array([], dtype="int64")
+        self.hashes = np.array([], dtype="uint64")
+        self.days = np.array([], dtype="int64")
+        self.schema_hash = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as index:
+            self.keys = index["keys"]
+            self.hashes = index["hashes"]
+            self.days = index["days"]
+            self.schema_hash = str(index["schema_hash"])
+        return True
+
+    def save(self):
+        temporary_path = self.path + ".tmp.npz"
+        np.savez(
+            temporary_path,
+            keys=self.keys,
+            hashes=self.hashes,
+            days=self.days,
+            schema_hash=np.array(self.schema_hash),
+        )
+        os.replace(temporary_path, self.path)
+
+    def rebuild(self, df, date_col, schema_hash):
+        keys = id_keys(df["id"])
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.hashes = row_hashes(df)[order]
+        self.days = days_since_epoch(df[date_col])[order]
+        self.schema_hash = schema_hash
+
+    def _locate(self, keys):
+        positions = np.searchsorted(self.keys, keys)
+        if len(self.keys) == 0:
+            return positions, np.zeros(len(keys), dtype=bool)
+        clipped_positions = np.minimum(positions, len(self.keys) - 1)
+        return clipped_positions, self.keys[clipped_positions] == keys
+
+    def classify(self, df):
+        """Returns masks of the rows with unseen ids and the rows replacing a stored row with different contents"""
+        positions, found = self._locate(id_keys(df["id"]))
+        changed = found & (self.hashes[positions] != row_hashes(df))
+        return ~found, changed
+
+    def contains(self, ids):
+        _, found = self._locate(id_keys(ids))
+        return found
+
+    def stored_days(self, ids):
+        positions, _ = self._locate(id_keys(ids))
+        return self.days[positions]
+
+    def remove(self, ids):
+        kept = ~np.isin(self.keys, id_keys(ids))
+        self.keys, self.hashes, self.days = (
+            self.keys[kept],
+            self.hashes[kept],
+            self.days[kept],
+        )
+
+    def update(self, df, date_col):
+        keys, hashes, days = id_keys(df["id"]), row_hashes(df), days_since_epoch(df[date_col])
+        positions, found = self._locate(keys)
+        self.hashes[positions[found]] = hashes[found]
+        self.days[positions[found]] = days[found]
+        keys = np.concatenate((self.keys, keys[~found]))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.hashes = np.concatenate((self.hashes, hashes[~found]))[order]
+        self.days = np.concatenate((self.days, days[~found]))[order]
+
+
+# Extracts mark rows deleted at the source with this column, carrying only their id
+REMOVED_COL = "removed"
+
+
+def split_removed_rows(df):
+    if REMOVED_COL not in df.columns:
+        return df, df["id"].iloc[:0]
+    removed = df[REMOVED_COL].fillna(False).astype(bool)
+    return df.loc[~removed].drop(columns=REMOVED_COL), df.loc[removed, "id"]
+
+
+def date_stats(df, date_col="date"):
+    if df.empty:
+        return {"min_date": None, "max_date": None, "row_count": 0}
+    return {
+        "min_date": str(df[date_col].min().date()),
+        "max_date": str(df[date_col].max().date()),
+        "row_count": len(df),
+    }
+
+
+def combine_date_stats(old, new):
+    if old is None or old["row_count"] == 0:
+        return new
+    if new["row_count"] == 0:
+        return old
+    return {
+        "min_date": min(old["min_date"], new["min_date"]),
+        "max_date": max(old["max_date"], new["max_date"]),
+        "row_count": old["row_count"] + new["row_count"],
+    }
+
+
+def overlaps_window(stats, start_date=None, end_date=None):
+    if stats is None:
+        # Without stats there's no telling, so the data has to be read
+        return True
+    if stats["row_count"] == 0:
+        return False
+    if start_date is not None and np.datetime64(stats["max_date"]) < start_date:
+        return False
+    if end_date is not None and np.datetime64(stats["min_date"]) > end_date:
+        return False
+    return True
+
+
+class OutputMetadata:
+    """JSON sidecar holding an output's date range, row count, schema hash and last extract time"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return json.load(f)
+        else:
+            return None
+
+    def write(self, metadata):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(temporary_path, self.path)
+
+
+class SyncCursor:
+    """Position in a source's change feed. A new position is only saved once the rows it covers are written."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = None
+
+    def read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return json.load(f).get("cursor")
+        else:
+            return None
+
+    def stage(self, cursor):
+        self.pending = cursor
+
+    def commit(self):
+        if self.pending is None:
+            return
+        with open(self.path, "w") as f:
+            json.dump({"cursor": self.pending}, f)
+        self.pending = None
+
+    def reset(self):
+        self.pending = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class WindowCheckpoints:
+    """Raw responses for the windows of a backfill that already succeeded, so a failed run resumes where it
+    stopped. Cleared once the output they feed has been written."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _window_path(self, start_date, end_date):
+        return os.path.join(self.path, f"{start_date}_{end_date}.json")
+
+    def read(self, start_date, end_date):
+        window_path = self._window_path(start_date, end_date)
+        if os.path.exists(window_path):
+            with open(window_path, "r") as f:
+                return json.load(f)
+        else:
+            return None
+
+    def save(self, start_date, end_date, payload):
+        os.makedirs(self.path, exist_ok=True)
+        window_path = self._window_path(start_date, end_date)
+        with open(window_path + ".tmp", "w") as f:
+            json.dump(payload, f)
+        os.replace(window_path + ".tmp", window_path)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class OutputFile:
+    """An extract output stored either as one file or, when partitioned, as a directory of period
+    partitions next to the configured path (hearts.csv becomes hearts/2023-01/part-00000.csv).
+    Partitions are append-only between compactions: incremental rows land in a new part file and
+    the latest copy of an id wins on read.
+    Every write refreshes a hearts.meta.json sidecar so date lookups don't touch the data."""
+
+    def __init__(self, path, schema, format="csv", partition=None, date_col="date"):
+        self.path = path
+        self._directory_path = self._get_directory_path()
+        self.schema = schema
+        if format not in FORMATS:
+            raise ValueError(f"Unknown output format {format}. Use one of {list(FORMATS)}")
+        self.format_name = format
+        self.format = FORMATS[format]
+        if partition is not None and partition not in PARTITION_PERIODS:
+            raise ValueError(
+                f"Unknown partition {partition}. Use one of {list(PARTITION_PERIODS)}"
+            )
+        self.partition = partition
+        self.date_col = date_col
+        self.metadata = OutputMetadata(os.path.splitext(path)[0] + ".meta.json")
+        self.index = IdIndex(os.path.splitext(path)[0] + ".ids.npz")
+        self.cursor = SyncCursor(os.path.splitext(path)[0] + ".cursor.json")
+        self.checkpoints = WindowCheckpoints(os.path.splitext(path)[0] + ".checkpoints")
+
+    @classmethod
+    def from_config(cls, endpoint_config):
+        return cls(
+            endpoint_config["output_path"],
+            Schema(endpoint_config["output_schema"]),
+            endpoint_config.get("output_format", "csv"),
+            endpoint_config.get("output_partition"),
+        )
+
+    def _get_directory_path(self):
+        return os.path.dirname(self.path)
+
+    def _directory_exists(self):
+        return os.path.exists(self._directory_path)
+
+    def _create_directory(self):
+        os.makedirs(self._directory_path)
+
+    def create_path(self):
+        if not self._directory_exists():
+            self._create_directory()
+
+    def exists(self):
+        if self.partition:
+            return os.path.isdir(self.partition_directory)
+        return os.path.exists(self.path)
+
+    @property
+    def partition_directory(self):
+        return os.path.splitext(self.path)[0]
+
+    def partitions(self):
+        if not self.exists():
+            return []
+        return sorted(
+            name
+            for name in os.listdir(self.partition_directory)
+            if os.path.isdir(os.path.join(self.partition_directory, name))
+        )
+
+    def _partition_keys(self, dates):
+        period = PARTITION_PERIODS[self.partition]
+        return pd.Series(dates).dt.to_period(period).astype(str).to_numpy()
+
+    def _part_paths(self, partition):
+        pattern = os.path.join(
+            self.partition_directory, partition, f"part-*{self.format.extension}"
+        )
+        return sorted(glob.glob(pattern))
+
+    def _next_part_path(self, partition):
+        part_paths = self._part_paths(partition)
+        if part_paths:
+            last_part = os.path.basename(part_paths[-1])
+            next_number = int(last_part[len("part-") :].split(".")[0]) + 1
+        else:
+            next_number = 0
+        directory_path = os.path.join(self.partition_directory, partition)
+        os.makedirs(directory_path, exist_ok=True)
+        return os.path.join(directory_path, f"part-{next_number:05d}{self.format.extension}")
+
+    def _empty_df(self, columns=None):
+        return self.schema.conform(
+            pd.DataFrame(columns=list(self.schema.subset(columns))), columns
+        )
+
+    def _read_partitions(self, partitions, columns=None):
+        # Superseded rows can linger in older parts until compaction, so reads always carry the id
+        read_columns = columns
+        if columns is not None and "id" not in columns:
+            read_columns = ["id"] + list(columns)
+        dfs = [
+            self.format.read(path, self.schema, read_columns)
+            for partition in partitions
+            for path in self._part_paths(partition)
+        ]
+        if not dfs:
+            return self._empty_df(columns)
+        df = pd.concat(dfs, axis=0).drop_duplicates(subset="id", keep="last")
+        return df.reset_index(drop=True)[list(self.schema.subset(columns))]
+
+    def schema_hash(self):
+        layout = {
+            "schema": self.schema.schema,
+            "format": self.format_name,
+            "partition": self.partition,
+        }
+        return hashlib.sha1(json.dumps(layout, sort_keys=True).encode()).hexdigest()
+
+    def get_metadata(self):
+        """Returns the sidecar, rebuilding it from the data if it's missing or describes another schema"""
+        if not self.exists():
+            return None
+        metadata = self.metadata.read()
+        if metadata is None or metadata["schema_hash"] != self.schema_hash():
+            getLogger.info(f"Rebuilding stale or missing metadata for {self.path}")
+            last_extract_at = metadata["last_extract_at"] if metadata else None
+            metadata = self._scan_metadata(last_extract_at)
+            self.metadata.write(metadata)
+        return metadata
+
+    def _scan_metadata(self, last_extract_at):
+        if not self.partition:
+            stats = date_stats(self.get_df(columns=[self.date_col]), self.date_col)
+            return self._build_metadata(stats, None, last_extract_at)
+        partition_stats = {
+            partition: date_stats(
+                self._read_partitions([partition], columns=[self.date_col]),
+                self.date_col,
+            )
+            for partition in self.partitions()
+        }
+        stats = None
+        for partition in partition_stats.values():
+            stats = combine_date_stats(stats, partition)
+        return self._build_metadata(stats, partition_stats, last_extract_at)
+
+    def _build_metadata(self, stats, partition_stats, last_extract_at):
+        metadata = dict(stats or date_stats(self._empty_df(), self.date_col))
+        metadata["schema_hash"] = self.schema_hash()
+        metadata["last_extract_at"] = last_extract_at
+        # The id scheme describes how the stored ids were derived, so it outlives rewrites of the data
+        previous_metadata = self.metadata.read() or {}
+        if previous_metadata.get("id_scheme") is not None:
+            metadata["id_scheme"] = previous_metadata["id_scheme"]
+        if partition_stats is not None:
+            metadata["partitions"] = partition_stats
+        return metadata
+
+    def _save_metadata(self, stats, partition_stats=None, extracted=True, **details):
+        if extracted:
+            last_extract_at = datetime.datetime.now().isoformat()
+        else:
+            previous_metadata = self.metadata.read() or {}
+            last_extract_at = previous_metadata.get("last_extract_at")
+        metadata = self._build_metadata(stats, partition_stats, last_extract_at)
+        metadata.update(details)
+        self.metadata.write(metadata)
+
+    def _get_index(self):
+        if not self.index.load() or self.index.schema_hash != self.schema_hash():
+            getLogger.info(f"Rebuilding stale or missing id index for {self.path}")
+            self.index.rebuild(self.get_df(), self.date_col, self.schema_hash())
+            self.index.save()
+        return self.index
+
+    def get_id_scheme(self):
+        metadata = self.get_metadata()
+        return None if metadata is None else metadata.get("id_scheme")
+
+    def set_id_scheme(self, id_scheme):
+        metadata = self.get_metadata()
+        if metadata is None or metadata.get("id_scheme") == id_scheme:
+            return
+        metadata["id_scheme"] = id_scheme
+        self.metadata.write(metadata)
+
+    def get_last_extract_time(self):
+        metadata = self.get_metadata()
+        if metadata is None or metadata["last_extract_at"] is None:
+            return None
+        return datetime.datetime.fromisoformat(metadata["last_extract_at"])
+
+    def get_df(self, columns=None, start_date=None, end_date=None):
+        """Reads the output, skipping files and partitions whose dates fall entirely outside the window"""
+        windowed = start_date is not None or end_date is not None
+        read_columns = columns
+        if windowed and columns is not None and self.date_col not in columns:
+            read_columns = [self.date_col] + list(columns)
+        if self.partition:
+            partitions = self.partitions()
+            if windowed:
+                partition_stats = self.get_metadata().get("partitions", {})
+                partitions = [
+                    p
+                    for p in partitions
+                    if overlaps_window(partition_stats.get(p), start_date, end_date)
+                ]
+            df = self._read_partitions(partitions, read_columns)
+        elif windowed and not overlaps_window(self.get_metadata(), start_date, end_date):
+            getLogger.info(
+                f"Skipping {self.path} since none of its rows fall between {start_date} and {end_date}"
+            )
+            df = self._empty_df(read_columns)
+        else:
+            df = self.format.read(self.path, self.schema, read_columns)
+        if windowed:
+            in_window = pd.Series(True, index=df.index)
+            if start_date is not None:
+                in_window &= df[self.date_col] >= start_date
+            if end_date is not None:
+                in_window &= df[self.date_col] <= end_date
+            df = df.loc[in_window, list(self.schema.subset(columns))]
+        return df
+
+    def write(self, df, extracted=True):
+        df, _ = split_removed_rows(df)
+        df = self.schema.conform(df)
+        if not self.partition:
+            self.format.write(df, self.path)
+            self._save_metadata(date_stats(df, self.date_col), extracted=extracted)
+            self.index.rebuild(df, self.date_col, self.schema_hash())
+            self.index.save()
+            return
+        # Partitions are rebuilt to the side and swapped in so a failed rewrite leaves the old ones intact
+        staging = OutputFile(
+            self.partition_directory + ".staging" + self.format.extension,
+            self.schema,
+            self.format_name,
+            self.partition,
+            self.date_col,
+        )
+        if os.path.isdir(staging.partition_directory):
+            shutil.rmtree(staging.partition_directory)
+        os.makedirs(staging.partition_directory)
+        partition_stats = {}
+        for partition, partition_df in df.groupby(self._partition_keys(df[self.date_col])):
+            self.format.write(partition_df, staging._next_part_path(partition))
+            partition_stats[partition] = date_stats(partition_df, self.date_col)
+        if os.path.isdir(self.partition_directory):
+            shutil.rmtree(self.partition_directory)
+        os.rename(staging.partition_directory, self.partition_directory)
+        self._save_metadata(
+            date_stats(df, self.date_col), partition_stats, extracted=extracted
+        )
+        self.index.rebuild(df, self.date_col, self.schema_hash())
+        self.index.save()
+
+    def merge(self, incremental_df):
+        """Writes only the incremental rows whose ids are new or whose contents changed, replacing the
+        stored copy of changed ids so updates (like pending Plaid transactions posting) don't duplicate.
+        Rows flagged in a removed column are deleted instead."""
+        incremental_df, removed_ids = split_removed_rows(incremental_df)
+        self.delete(removed_ids)
+        if incremental_df.empty:
+            # A sync that only removed rows leaves nothing, not even the schema's columns, to merge
+            if self.exists():
+                self._save_metadata(
+                    self._stored_stats(),
+                    self.get_metadata().get("partitions"),
+                    replaced_ids=[],
+                )
+            return
+        incremental_df = self.schema.conform(incremental_df).drop_duplicates(
+            subset="id", keep="last"
+        )
+        if not self.exists():
+            self.write(incremental_df)
+            return
+        index = self._get_index()
+        new, replaced = index.classify(incremental_df)
+        changed_df = incremental_df.loc[new | replaced]
+        replaced_ids = incremental_df.loc[replaced, "id"]
+        getLogger.info(
+            f"Incremental extract fetched {len(incremental_df)} rows of which {new.sum()} are new and {replaced.sum()} replace stored rows in {self.path}"
+        )
+        if not changed_df.empty:
+            self._write_changes(changed_df, replaced[new | replaced], replaced_ids)
+        metadata = self.metadata.read()
+        metadata["replaced_ids"] = replaced_ids.tolist()
+        self.metadata.write(metadata)
+
+    def _write_changes(self, changed_df, replaced, replaced_ids):
+        if self.partition:
+            self._append_to_partitions(changed_df, replaced)
+        elif replaced.any() or self.format.append is None:
+            existing_df = self.get_df()
+            existing_df = existing_df.loc[~existing_df["id"].isin(replaced_ids)]
+            self.write(pd.concat((existing_df, changed_df), axis=0))
+        else:
+            self.format.append(changed_df, self.path)
+            self._update_index(changed_df)
+            stats = combine_date_stats(
+                self._stored_stats(), date_stats(changed_df, self.date_col)
+            )
+            self._save_metadata(stats)
+
+    def _stored_stats(self):
+        metadata = self.get_metadata()
+        return {k: metadata[k] for k in ["min_date", "max_date", "row_count"]}
+
+    def _update_index(self, changed_df):
+        self.index.update(changed_df, self.date_col)
+        self.index.save()
+
+    def _append_to_partitions(self, changed_df, replaced):
+        partition_stats = self.get_metadata()["partitions"]
+        stats = self._stored_stats()
+        new_partitions = self._partition_keys(changed_df[self.date_col])
+        stored_partitions = self._partition_keys(
+            self.index.stored_days(changed_df["id"]).astype("datetime64[D]")
+        )
+        # Rows updated in place are superseded by the appended copy, but rows whose date moved to
+        # another partition have to be dropped from the partition that held them
+        moved = replaced & (new_partitions != stored_partitions)
+        added = ~replaced | moved
+        for partition in np.unique(new_partitions):
+            partition_df = changed_df.loc[new_partitions == partition]
+            self.format.write(partition_df, self._next_part_path(partition))
+            new_stats = date_stats(partition_df, self.date_col)
+            new_stats["row_count"] = int((added & (new_partitions == partition)).sum())
+            partition_stats[partition] = combine_date_stats(
+                partition_stats.get(partition), new_stats
+            )
+            stats = combine_date_stats(stats, new_stats)
+        # New copies are written before the old ones are dropped so a failure can't lose rows
+        for partition in np.unique(stored_partitions[moved]):
+            moved_ids = changed_df.loc[moved & (stored_partitions == partition), "id"]
+            self._drop_from_partition(partition, moved_ids, partition_stats)
+            stats["row_count"] -= len(moved_ids)
+        self._update_index(changed_df)
+        self._save_metadata(stats, partition_stats)
+        getLogger.info(
+            f"Appended {len(changed_df)} rows across {len(np.unique(new_partitions))} partitions of {self.partition_directory}"
+        )
+
+    def delete(self, ids):
+        """Removes stored rows by id, rewriting only the file or the partitions that hold them"""
+        ids = pd.Series(ids, dtype=object).astype(self.schema.schema["id"])
+        if not self.exists() or ids.empty:
+            return
+        index = self._get_index()
+        ids = ids.loc[index.contains(ids)].drop_duplicates()
+        getLogger.info(f"Deleting {len(ids)} stored rows from {self.path}")
+        if ids.empty:
+            return
+        if not self.partition:
+            df = self.get_df()
+            self.write(df.loc[~df["id"].isin(ids)])
+            return
+        partition_stats = self.get_metadata()["partitions"]
+        stored_partitions = self._partition_keys(
+            index.stored_days(ids).astype("datetime64[D]")
+        )
+        for partition in np.unique(stored_partitions):
+            self._drop_from_partition(
+                partition, ids.loc[stored_partitions == partition], partition_stats
+            )
+        stats = None
+        for partition in partition_stats.values():
+            stats = combine_date_stats(stats, partition)
+        index.remove(ids)
+        index.save()
+        self._save_metadata(stats, partition_stats)
+
+    def _drop_from_partition(self, partition, ids, partition_stats):
+        part_paths = self._part_paths(partition)
+        partition_df = self._read_partitions([partition])
+        partition_df = partition_df.loc[~partition_df["id"].isin(ids)]
+        # The old parts are only removed once the rewritten one is in place
+        self.format.write(partition_df, self._next_part_path(partition))
+        for path in part_paths:
+            os.remove(path)
+        partition_stats[partition] = date_stats(partition_df, self.date_col)
+
+    def compact(self):
+        """Merges each partition's part files into one and drops rows superseded by a later copy"""
+        if not self.partition or not self.exists():
+            return
+        part_count = sum(len(self._part_paths(p)) for p in self.partitions())
+        df = self.get_df()
+        self.write(df, extracted=False)
+        getLogger.info(
+            f"Compacted {part_count} part files into {len(self.partitions())} partitions holding {len(df)} rows in {self.partition_directory}"
+        )
+
+    def fingerprint(self):
+        """Hash of every stored id and row, which changes whenever the output's contents do"""
+        if not self.exists():
+            return None
+        index = self._get_index()
+        digest = hashlib.sha1(index.keys.tobytes())
+        digest.update(index.hashes.tobytes())
+        return digest.hexdigest()
+
+    def get_replaced_ids(self):
+        """Ids whose stored rows were replaced by the most recent merge"""
+        metadata = self.get_metadata()
+        return [] if metadata is None else metadata.get("replaced_ids", [])
+
+    def get_latest_row_date(self, date_col="date"):
+        if date_col == self.date_col:
+            max_date = self.get_metadata()["max_date"]
+            return None if max_date is None else np.datetime64(max_date)
+        df = self.get_df(columns=[date_col])
+        latest_row_date = np.datetime64(df[date_col].max().date())
+        return latest_row_date
@@ -0,0 +1,191 @@
+from threading import BoundedSemaphore, Lock
+import logging as getLogger
+import random
+import time
+import urllib3
+
+
+RATE_LIMIT = "rate limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+TRANSIENT_STATUSES = {408, 500, 502, 503, 504}
+
+# Every provider's throttle by name, for reporting
+THROTTLES = {}
+
+
+class RateLimiter:
+    """Token bucket allowing `calls` requests per `period` seconds. One instance is shared by every
+    thread calling the same API so they draw from a single budget."""
+
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.rate = calls / period
+        self.tokens = calls
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.calls, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds):
+        # The server said the budget is spent, so nobody gets a token until it says otherwise
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def acquire(self):
+        """Blocks until a request is allowed and returns the seconds spent waiting"""
+        waited = 0
+        while True:
+            with self.lock:
+                self._refill()
+                paused_for = self.paused_until - time.monotonic()
+                if paused_for <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait_seconds = max(paused_for, (1 - self.tokens) / self.rate)
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+
+def error_status(error):
+    # Plaid and Strava's generated clients, requests and Splitwise each keep the status somewhere else
+    for status in (
+        getattr(error, "status", None),
+        getattr(error, "http_status", None),
+        getattr(getattr(error, "response", None), "status_code", None),
+    ):
+        if isinstance(status, int) and status > 0:
+            return status
+    return None
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it said"""
+    if getattr(error, "retry_after_secs", None) is not None:
+        return float(error.retry_after_secs)
+    headers = getattr(error, "headers", None) or getattr(
+        getattr(error, "response", None), "headers", None
+    )
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    status = error_status(error)
+    if status == 429 or hasattr(error, "retry_after_secs"):
+        return RATE_LIMIT
+    if status in TRANSIENT_STATUSES:
+        return TRANSIENT
+    if status is None and isinstance(error, (OSError, urllib3.exceptions.HTTPError)):
+        # Dropped connections and timeouts never got as far as a status
+        return TRANSIENT
+    return FATAL
+
+
+class Throttle:
+    """Client-side throttling for one provider. Calls wait for a token from every quota, run with a
+    bounded number in flight, and are retried with jittered exponential backoff when the error is a
+    rate limit or transient. Fatal errors are raised straight away."""
+
+    def __init__(
+        self,
+        name,
+        quotas,
+        max_concurrent=4,
+        max_retries=6,
+        base_delay=1,
+        max_delay=300,
+        classify=classify_error,
+    ):
+        self.name = name
+        self.limiters = [RateLimiter(calls, period) for calls, period in quotas]
+        self.in_flight = BoundedSemaphore(max_concurrent)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.classify = classify
+        self.metrics_lock = Lock()
+        self.metrics = {
+            "calls": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "token_wait_seconds": 0.0,
+            "backoff_seconds": 0.0,
+        }
+        THROTTLES[name] = self
+
+    def _record(self, **increments):
+        with self.metrics_lock:
+            for key, value in increments.items():
+                self.metrics[key] += value
+
+    def snapshot(self):
+        with self.metrics_lock:
+            return dict(self.metrics)
+
+    def backoff(self, attempt, error, kind):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        server_delay = retry_after(error)
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        if kind == RATE_LIMIT:
+            for limiter in self.limiters:
+                limiter.pause(delay)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            with self.in_flight:
+                waited = sum(limiter.acquire() for limiter in self.limiters)
+                self._record(calls=1, token_wait_seconds=waited)
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    kind = self.classify(e)
+                    if kind == FATAL or attempt >= self.max_retries:
+                        raise
+                    delay = self.backoff(attempt, e, kind)
+                    getLogger.info(
+                        f"{self.name} {kind} error ({e}). Retrying in {delay:.1f} seconds."
+                    )
+            # Wait outside the in flight slot so other calls can use it
+            self._record(retries=1)
+            if kind == RATE_LIMIT:
+                # The pause is counted as quota wait when the next token is acquired
+                self._record(rate_limited=1)
+            else:
+                self._record(backoff_seconds=delay)
+                time.sleep(delay)
+            attempt += 1
+
+
+def throttle_snapshots():
+    return {name: throttle.snapshot() for name, throttle in THROTTLES.items()}
+
+
+def log_throttle_metrics(since=None):
+    """Logs each throttle's activity since the snapshots in since, or over the process's lifetime.
+    The counters outlive a run, since the background refresher reruns the ETL in one process."""
+    since = since or {}
+    for name, throttle in THROTTLES.items():
+        before = since.get(name, {})
+        metrics = {
+            key: value - before.get(key, 0) for key, value in throttle.snapshot().items()
+        }
+        if metrics["calls"]:
+            getLogger.info(
+                f"{name}: {metrics['calls']} calls, {metrics['retries']} retries "
+                f"({metrics['rate_limited']} rate limited), "
+                f"{metrics['token_wait_seconds']:.1f}s waiting for quota, "
+                f"{metrics['backoff_seconds']:.1f}s backing off"
+            )
@@ -0,0 +1,52 @@
+import logging as getLogger
+import numpy as np
+import pandas as pd
+from mosaic.extract.fitbit_intraday import ZONE_COLUMNS
+from mosaic.storage import OutputFile
+from mosaic.utils import to_csv_atomically
+
+
+def read_heart_minutes(extract_intraday_endpoint, start_date, end_date):
+    # Rollups are stamped by minute, so the window runs through the end of its last day
+    next_day = end_date + np.timedelta64(1, "D")
+    minutes = OutputFile.from_config(extract_intraday_endpoint).get_df(
+        start_date=start_date, end_date=next_day
+    )
+    return minutes.loc[minutes["date"] < next_day]
+
+
+def hourly_rollup(minutes):
+    """Folds per minute rollups into hours, weighting means by each minute's readings"""
+    minutes = minutes.assign(
+        hour=minutes["date"].dt.floor("h"),
+        bpm_total=minutes["bpm_mean"].astype("float64") * minutes["samples"],
+    )
+    hours = minutes.groupby("hour").agg(
+        bpm_total=("bpm_total", "sum"),
+        bpm_min=("bpm_min", "min"),
+        bpm_max=("bpm_max", "max"),
+        samples=("samples", "sum"),
+        **{col: (col, "sum") for col in ZONE_COLUMNS.values()},
+    )
+    hours["bpm_mean"] = hours.pop("bpm_total") / hours["samples"]
+    return hours.rename_axis("date").reset_index()
+
+
+def daily_zone_minutes(minutes):
+    """Minutes spent in each heart rate zone per day"""
+    days = minutes.groupby(minutes["date"].dt.normalize())[list(ZONE_COLUMNS.values())].sum()
+    days = days / 60
+    days.columns = [col.replace("_seconds", "_minutes") for col in days.columns]
+    return days.rename_axis("date").reset_index()
+
+
+def transform_heart_rate(
+    extract_fitbit_endpoints, start_date, end_date, output_path, zones_output_path
+):
+    minutes = read_heart_minutes(
+        extract_fitbit_endpoints["activities/heart/intraday"], start_date, end_date
+    )
+    hours = hourly_rollup(minutes)
+    getLogger.info(f"Rolled {len(minutes)} minutes of heart rate into {len(hours)} hours")
+    to_csv_atomically(hours, output_path, index=False)
+    to_csv_atomically(daily_zone_minutes(minutes), zones_output_path, index=False)
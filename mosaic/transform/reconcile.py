@@ -0,0 +1,220 @@
+import logging as getLogger
+import numpy as np
+import pandas as pd
+
+
+class BandRule:
+    """Matches a Plaid transaction to a Splitwise expense whose amount is within `tolerance` of it and
+    whose date is `min_days` to `max_days` before it, like `plaid.date between date(splitwise.date,
+    '+min_days') and date(splitwise.date, '+max_days')`. Filters pick the rows each side may match
+    from and `equal` lists (plaid, splitwise) columns that must also be equal."""
+
+    def __init__(
+        self,
+        name,
+        splitwise_amount,
+        tolerance,
+        min_days,
+        max_days,
+        plaid_filter=None,
+        splitwise_filter=None,
+        equal=(),
+    ):
+        self.name = name
+        self.splitwise_amount = splitwise_amount
+        self.tolerance = tolerance
+        self.min_days = min_days
+        self.max_days = max_days
+        self.plaid_filter = plaid_filter
+        self.splitwise_filter = splitwise_filter
+        self.equal = equal
+
+    @staticmethod
+    def _positions(df, row_filter):
+        if row_filter is None:
+            return np.arange(len(df))
+        return np.flatnonzero(row_filter(df).fillna(False).to_numpy(dtype=bool))
+
+    def match(self, plaid, splitwise, plaid_days, splitwise_days):
+        """Positions of every matching (plaid, splitwise) pair"""
+        plaid_rows = self._positions(plaid, self.plaid_filter)
+        splitwise_rows = self._positions(splitwise, self.splitwise_filter)
+        # Sorting one side by date turns each date window into a contiguous run found by binary search
+        order = np.argsort(splitwise_days[splitwise_rows], kind="stable")
+        splitwise_rows = splitwise_rows[order]
+        sorted_days = splitwise_days[splitwise_rows]
+        first = np.searchsorted(sorted_days, plaid_days[plaid_rows] - self.max_days, "left")
+        last = np.searchsorted(sorted_days, plaid_days[plaid_rows] - self.min_days, "right")
+        counts = np.maximum(last - first, 0)
+        left = np.repeat(plaid_rows, counts)
+        run_starts = np.repeat(first - (np.cumsum(counts) - counts), counts)
+        right = splitwise_rows[np.arange(counts.sum()) + run_starts]
+
+        plaid_amounts = plaid["amount"].to_numpy(dtype="float64")[left]
+        splitwise_amounts = splitwise[self.splitwise_amount].to_numpy(dtype="float64")[right]
+        # Same arithmetic as SQL's between, so matches on the boundary agree
+        keep = (splitwise_amounts >= plaid_amounts - self.tolerance) & (
+            splitwise_amounts <= plaid_amounts + self.tolerance
+        )
+        for plaid_col, splitwise_col in self.equal:
+            plaid_values = plaid[plaid_col].to_numpy(dtype=object)[left]
+            splitwise_values = splitwise[splitwise_col].to_numpy(dtype=object)[right]
+            keep &= pd.notna(plaid_values) & (plaid_values == splitwise_values)
+        return left[keep], right[keep]
+
+
+def to_days(dates):
+    return pd.to_datetime(dates).to_numpy().astype("datetime64[D]").astype("int64")
+
+
+def band_join(plaid, splitwise, rules):
+    """Pairs matching any of the rules, in the order a nested loop over plaid then splitwise finds them"""
+    plaid_days, splitwise_days = to_days(plaid["date"]), to_days(splitwise["date"])
+    lefts, rights = [], []
+    for rule in rules:
+        left, right = rule.match(plaid, splitwise, plaid_days, splitwise_days)
+        getLogger.debug(f"{rule.name} matched {len(left)} pairs")
+        lefts.append(left)
+        rights.append(right)
+    pairs = np.unique(
+        np.column_stack((np.concatenate(lefts), np.concatenate(rights))).astype("int64"),
+        axis=0,
+    )
+    return pairs[:, 0], pairs[:, 1]
+
+
+def is_venmo_from(account):
+    return lambda plaid: (plaid["account"] == account) & (plaid["name"] == "Venmo")
+
+
+# venmo_payments_from_aspiration_to_splitwise.sql
+VENMO_PAYMENT_RULES = [
+    BandRule(
+        "Venmo payment settling a Splitwise balance",
+        splitwise_amount="net_balance",
+        # Amount should be about the same, allowing for rounding errors
+        tolerance=1,
+        # A 1 day delay between financial accounts seems ubiquitous. We allow for 2 days for some flexibility
+        min_days=0,
+        max_days=2,
+        plaid_filter=lambda plaid: is_venmo_from("aspiration")(plaid) & (plaid["amount"] > 0),
+        splitwise_filter=lambda splitwise: splitwise["is_payment"].astype(bool)
+        & (splitwise["net_balance"] > 0),
+    )
+]
+
+# venmo_income_net_of_splitwise_balance.sql
+VENMO_INCOME_RULES = [
+    BandRule(
+        "Venmo income including a Splitwise repayment",
+        splitwise_amount="net_balance",
+        # Transfers from Venmo include any other transactions that occured between transfers
+        tolerance=1010,
+        # Transfers from Venmo often occur well after the payment from Splitwise
+        min_days=0,
+        max_days=20,
+        plaid_filter=lambda plaid: is_venmo_from("aspiration")(plaid) & (plaid["amount"] < 0),
+        splitwise_filter=lambda splitwise: splitwise["is_payment"].astype(bool)
+        & (splitwise["net_balance"] < 0),
+    )
+]
+
+
+def paid_group_expense(splitwise):
+    return ~splitwise["is_payment"].astype(bool) & (splitwise["paid_share"] > 0)
+
+
+def not_venmo(plaid):
+    return plaid["name"].notna() & (plaid["name"] != "Venmo")
+
+
+# transactions_with_my_share_of_group_amounts.sql
+GROUP_SHARE_RULES = [
+    BandRule(
+        "Amazon grocery pickup",
+        splitwise_amount="paid_share",
+        # Greater flexibility on amount accommodates tips for whole foods grocery store pickups coordinated by Amazon
+        tolerance=15,
+        min_days=-1,
+        max_days=1,
+        plaid_filter=lambda plaid: not_venmo(plaid)
+        & (plaid["name"].str[:6].str.lower() == "amazon"),
+        splitwise_filter=paid_group_expense,
+    ),
+    BandRule(
+        "Rent paid by check",
+        splitwise_amount="paid_share",
+        tolerance=5,
+        # Landlords don't always cash the checks in a timely fashion so rent needs flexible time windows
+        min_days=-15,
+        max_days=15,
+        plaid_filter=lambda plaid: not_venmo(plaid)
+        & (plaid["name"] == "Convenience Check Adjustment"),
+        splitwise_filter=paid_group_expense,
+    ),
+    BandRule(
+        "Group expense",
+        splitwise_amount="paid_share",
+        tolerance=5,
+        min_days=-1,
+        max_days=1,
+        plaid_filter=not_venmo,
+        splitwise_filter=paid_group_expense,
+        # Assumes good categorization in the extract step
+        equal=[("category", "category")],
+    ),
+]
+
+
+ALL_RULES = VENMO_PAYMENT_RULES + VENMO_INCOME_RULES + GROUP_SHARE_RULES
+
+
+def splitwise_window(start_date, end_date, rules=ALL_RULES):
+    """Dates of the Splitwise expenses that transactions between start_date and end_date could match"""
+    return (
+        start_date - np.timedelta64(max(rule.max_days for rule in rules), "D"),
+        end_date - np.timedelta64(min(rule.min_days for rule in rules), "D"),
+    )
+
+
+def drop_venmo_payments(plaid, splitwise):
+    """Plaid transactions without the Venmo payments that settle up Splitwise balances"""
+    matched, _ = band_join(plaid, splitwise, VENMO_PAYMENT_RULES)
+    keep = np.ones(len(plaid), dtype=bool)
+    keep[matched] = False
+    return plaid.loc[keep].reset_index(drop=True)
+
+
+def net_venmo_income(plaid, splitwise):
+    """Amounts with the Splitwise repayment taken out of each Venmo transfer. A transfer matching several
+    repayments nets out the first, where the SQL's extra join rows would misalign every later amount."""
+    matched, repayments = band_join(plaid, splitwise, VENMO_INCOME_RULES)
+    first = np.unique(matched, return_index=True)[1]
+    net_balance = pd.Series(np.nan, index=plaid.index)
+    net_balance.iloc[matched[first]] = splitwise["net_balance"].to_numpy()[repayments[first]]
+    amount = (plaid["amount"] - net_balance).fillna(plaid["amount"]).fillna(0)
+    return amount.to_frame("amount")
+
+
+def apply_group_shares(plaid, splitwise):
+    """Replaces the amount of group expenses I paid for with my share, one row per matching expense"""
+    matched, expenses = band_join(plaid, splitwise, GROUP_SHARE_RULES)
+    # A left join keeps unmatched transactions in place, with nothing from splitwise
+    unmatched = np.setdiff1d(np.arange(len(plaid)), matched)
+    left = np.concatenate((matched, unmatched))
+    right = np.concatenate((expenses, np.full(len(unmatched), -1)))
+    order = np.lexsort((right, left))
+    left, right = left[order], right[order]
+    has_match = right >= 0
+
+    columns = ["id", "name", "date", "category", "account", "merchant_name", "amount"]
+    df = plaid.iloc[left][columns].reset_index(drop=True)
+    splitwise_category = pd.Series(
+        np.where(has_match, splitwise["category"].to_numpy(dtype=object)[right], None)
+    )
+    splitwise_share = pd.Series(
+        np.where(has_match, splitwise["net_balance"].to_numpy(dtype="float64")[right], np.nan)
+    )
+    df["category"] = splitwise_category.where(splitwise_category.notna(), df["category"])
+    df["amount"] = splitwise_share.fillna(df["amount"])
+    return df
@@ -0,0 +1,94 @@
+import logging as getLogger
+import re
+import numpy as np
+import pandas as pd
+from prettytable import PrettyTable, PLAIN_COLUMNS
+from mosaic.utils import lookup_yaml
+
+
+RULES_PATH = "transaction_rules.yml"
+ACTIONS = ["exclude", "fixed", "trace"]
+
+
+class TransactionRule:
+    """One rule from transaction_rules.yml with its predicates compiled for vectorized matching"""
+
+    def __init__(self, name, action, name_exact=(), name_prefix=(), name_regex=(), ids=(), categories=()):
+        if action not in ACTIONS:
+            raise ValueError(f"Rule {name} has unknown action {action}")
+        self.name = name
+        self.action = action
+        self.name_exact = list(name_exact)
+        self.name_prefix = tuple(name_prefix)
+        self.name_regex = re.compile("|".join(f"(?:{r})" for r in name_regex)) if name_regex else None
+        self.ids = list(ids)
+        self.categories = list(categories)
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(
+            name,
+            config["action"],
+            name_exact=config.get("name") or (),
+            name_prefix=config.get("name_prefix") or (),
+            name_regex=config.get("name_regex") or (),
+            ids=config.get("id") or (),
+            categories=config.get("category") or (),
+        )
+
+    def mask(self, df):
+        mask = np.zeros(len(df), dtype=bool)
+        if self.name_exact:
+            mask |= df["name"].isin(self.name_exact).to_numpy()
+        if self.name_prefix:
+            mask |= df["name"].str.startswith(self.name_prefix, na=False).to_numpy(dtype=bool)
+        if self.name_regex is not None:
+            mask |= df["name"].str.contains(self.name_regex, na=False).to_numpy(dtype=bool)
+        if self.ids:
+            mask |= df["id"].isin(self.ids).to_numpy()
+        if self.categories:
+            mask |= df["category"].isin(self.categories).to_numpy()
+        return mask
+
+
+class TransactionRules:
+    """Exclusions and flags for transactions, evaluated as one boolean mask per rule"""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    @classmethod
+    def from_yaml(cls, path=RULES_PATH):
+        return cls(
+            [TransactionRule.from_config(name, config) for name, config in lookup_yaml(path).items()]
+        )
+
+    def of_action(self, action):
+        return [rule for rule in self.rules if rule.action == action]
+
+    def traced_ids(self):
+        return [i for rule in self.of_action("trace") for i in rule.ids]
+
+    def apply(self, df):
+        """Drops excluded transactions and marks fixed ones as not variable, logging what each rule hit"""
+        t = PrettyTable()
+        t.set_style(PLAIN_COLUMNS)
+        t.field_names = ["rule", "action", "count", "$"]
+        amounts = df["amount"].to_numpy(dtype="float64")
+        excluded = np.zeros(len(df), dtype=bool)
+        fixed = np.zeros(len(df), dtype=bool)
+        for rule in self.rules:
+            if rule.action == "trace":
+                continue
+            mask = rule.mask(df)
+            # Impact is what the rule itself removes or reclassifies, beyond earlier rules
+            hits = mask & ~excluded
+            t.add_row([rule.name, rule.action, int(hits.sum()), round(amounts[hits].sum(), 2)])
+            if rule.action == "exclude":
+                excluded |= mask
+            else:
+                fixed |= mask
+        getLogger.info(t)
+        df = df.loc[~excluded].copy()
+        df["is_variable"] = ~fixed[~excluded]
+        return df
@@ -2,10 +2,8 @@ import inflection
 import logging as getLogger
 import pandas as pd
 from datetime import datetime
-from mosaic.utils import (
-    convert_vector_to_date,
-    snakecase_format,
-)
+from mosaic.storage import OutputFile
+from mosaic.utils import snakecase_format, to_csv_atomically
 
 
 getLogger.getLogger().setLevel(getLogger.INFO)
@@ -19,10 +17,15 @@ def mps_to_mph(meters_per_second):
     return meters_per_second * 2.2369362921
 
 
-def transform_skis(start_date, end_date, extract_strava_path, output_path):
-    df = pd.read_csv(extract_strava_path)
-    getLogger.info(f"Read strava data from {extract_strava_path}:\n{df.head()}")
-    df["date"] = convert_vector_to_date(df["date"])
+def transform_skis(start_date, end_date, extract_strava_endpoint, output_path):
+    strava = OutputFile.from_config(extract_strava_endpoint)
+    df = strava.get_df(
+        columns=["id", "date", "type", "total_elevation_gain", "max_speed"],
+        start_date=start_date,
+        end_date=end_date,
+    )
+    getLogger.info(f"Read strava data from {strava.path}:\n{df.head()}")
+    df["date"] = df["date"].dt.normalize()
     df["total_elevation_gain"] = meters_to_feet(df["total_elevation_gain"])
     df["type"] = df["type"].apply(lambda x: snakecase_format(x))
     df["max_speed"] = mps_to_mph(df["max_speed"])
@@ -44,7 +47,7 @@ def transform_skis(start_date, end_date, extract_strava_path, output_path):
     getLogger.info(
         f"Outputting ski data between {start_date} and {end_date} to {output_path}:\n{df.head()}"
     )
-    df.to_csv(output_path)
+    to_csv_atomically(df, output_path)
 
 
 if __name__ == "__main__":
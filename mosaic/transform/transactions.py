@@ -1,13 +1,18 @@
 from mosaic.utils import (
     convert_vector_to_date,
     convert_string_to_date,
+    date_period_vector,
+    to_csv_atomically,
 )
 from prettytable import PrettyTable, PLAIN_COLUMNS
 import ast
 import logging as getLogger
 import pandas as pd
-import pandasql
 import os
+import sqlite3
+from mosaic.storage import OutputFile
+from mosaic.transform import reconcile
+from mosaic.transform.rules import TransactionRules, RULES_PATH
 
 pd.options.display.max_rows = None
 pd.options.display.max_columns = None
@@ -15,40 +20,44 @@ getLogger.getLogger().setLevel(getLogger.DEBUG)
 transform_dir = "mosaic/transform/"
 
 
-def read_plaid_transactions(endpoints):
+def format_dates_for_sql(df, date_col="date"):
+    # SQLite compares dates as ISO strings, so typed timestamps are rendered without a time component
+    df[date_col] = df[date_col].dt.strftime("%Y-%m-%d")
+    return df
+
+
+def read_plaid_transactions(endpoints, start_date=None, end_date=None):
     transactions = []
     for account, config in endpoints.items():
-        transactions.append(pd.read_csv(config["output_path"]))
+        transactions.append(
+            OutputFile.from_config(config).get_df(start_date=start_date, end_date=end_date)
+        )
     transactions = pd.concat(transactions).sort_values("date").reset_index(drop=True)
-    return transactions
-
-
-def read_query(path):
-    with open(path, "r") as f:
-        return f.read()
+    return format_dates_for_sql(transactions)
 
 
-def date_period_vector(v, period):
-    return convert_vector_to_date(
-        pd.to_datetime(v).dt.to_period(period).dt.to_timestamp().astype(str)
+def read_splitwise_expenses(endpoint, start_date=None, end_date=None):
+    splitwise = (
+        OutputFile.from_config(endpoint)
+        .get_df(start_date=start_date, end_date=end_date)
+        .dropna(subset=["net_balance"])
     )
+    # Typed formats hand back the user name lists as arrays, which SQLite can't store
+    splitwise["user_names"] = splitwise["user_names"].astype(str)
+    return format_dates_for_sql(splitwise)
 
 
-def verbose_query(plaid, splitwise, query):
-    t = PrettyTable()
-    t.set_style(PLAIN_COLUMNS)
-    t.add_column("old", [len(plaid), round(sum(plaid["amount"]), 2)])
-    transformed_data = pandasql.sqldf(query, locals())
-    t.add_column(
-        "new", [len(transformed_data), round(sum(transformed_data["amount"]), 2)]
-    )
-    getLogger.info(t)
-    return transformed_data
+def read_query(path):
+    with open(path, "r") as f:
+        return f.read()
 
 
-VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE = read_query(
-    f"{transform_dir}venmo_payments_from_aspiration_to_splitwise.sql"
-)
+QUERY_PATHS = [
+    f"{transform_dir}venmo_payments_from_aspiration_to_splitwise.sql",
+    f"{transform_dir}venmo_income_net_of_splitwise_balance.sql",
+    f"{transform_dir}transactions_with_my_share_of_group_amounts.sql",
+]
+VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE = read_query(QUERY_PATHS[0])
 TRANSACTIONS_WITHOUT_VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE = f"""
     select plaid.*
       from plaid
@@ -56,50 +65,157 @@ TRANSACTIONS_WITHOUT_VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE = f"""
                 on payments.id = plaid.id
      where payments.id isnull
     """
-TRANSACTIONS_WITH_VENMO_INCOME_NET_OF_SPLITWISE_BALANCE = read_query(
-    f"{transform_dir}venmo_income_net_of_splitwise_balance.sql"
-)
-TRANSACTIONS_WITH_MY_SHARE_OF_GROUP_AMOUNTS = read_query(
-    f"{transform_dir}transactions_with_my_share_of_group_amounts.sql"
-)
+TRANSACTIONS_WITH_VENMO_INCOME_NET_OF_SPLITWISE_BALANCE = read_query(QUERY_PATHS[1])
+TRANSACTIONS_WITH_MY_SHARE_OF_GROUP_AMOUNTS = read_query(QUERY_PATHS[2])
 
 
-def transform_transactions(
-    start_date, end_date, extract_plaid_endpoints, extract_splitwise_path, output_path
-):
-    plaid = read_plaid_transactions(extract_plaid_endpoints)
+class SqlSession:
+    """Runs the reconciliation queries in one in-memory SQLite database per transform. The inputs are
+    loaded and indexed once, each query replaces the plaid table in place, and only the final result
+    comes back to pandas."""
 
-    splitwise = pd.read_csv(extract_splitwise_path).dropna(subset=["net_balance"])
+    def __init__(self, plaid, splitwise):
+        self.connection = sqlite3.connect(":memory:")
+        plaid.to_sql("plaid", self.connection, index=False)
+        splitwise.to_sql("splitwise", self.connection, index=False)
+        # The band joins probe splitwise by amount and date
+        for col in ["date", "net_balance", "paid_share"]:
+            self.connection.execute(f"create index splitwise_{col} on splitwise ({col})")
+        self._index_plaid()
 
-    getLogger.info(
-        "Lump payments and income from Venmo disguise how cash is actually being spent, which is captured by Splitwise"
-    )
-    plaid = verbose_query(
-        plaid,
-        splitwise,
-        TRANSACTIONS_WITHOUT_VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE,
-    )
+    def _index_plaid(self):
+        for col in ["id", "date"]:
+            self.connection.execute(f"create index plaid_{col} on plaid ({col})")
 
-    getLogger.info(f"For my income from Venmo, removing Splitwise share from the total")
-    shared_transaction_examples = [
-        "Je3vNdZXRVU3oaOPP6p5tKz5zyDyneiqRDrrA",
-        "gvX3p6KMaeIgJB9ZZ3aXSmx8JDoxXDi3yqnVN",
-    ]
-    is_shared_payment = plaid["id"].isin(shared_transaction_examples)
-    plaid["amount"] = verbose_query(
-        plaid, splitwise, TRANSACTIONS_WITH_VENMO_INCOME_NET_OF_SPLITWISE_BALANCE
-    )
-    getLogger.debug(
-        f"""Shared Venmo payments after adjustment\n{plaid.loc[is_shared_payment, 'amount']}"""
-    )
+    def _replace_plaid(self, query):
+        self.connection.execute(f"create table next_plaid as {query}")
+        self.connection.execute("drop table plaid")
+        self.connection.execute("alter table next_plaid rename to plaid")
+        self._index_plaid()
 
-    getLogger.info(
-        "Now that we have adjusted the lump payments, we can layer in Splitwise transactions to get a more nuanced understanding of spending"
-    )
-    getLogger.info(
-        f"For group expenses paid by me, replacing full amount from Plaid with my share from Splitwise"
+    def totals(self):
+        return self.connection.execute(
+            "select count(*), round(coalesce(sum(amount), 0), 2) from plaid"
+        ).fetchone()
+
+    def drop_venmo_payments(self):
+        self._replace_plaid(TRANSACTIONS_WITHOUT_VENMO_PAYMENTS_FROM_ASPIRATION_TO_SPLITWISE)
+
+    def net_venmo_income(self):
+        # The query returns one amount per plaid row in table order, which lines up on rowid
+        self.connection.execute(
+            f"create table venmo_income as {TRANSACTIONS_WITH_VENMO_INCOME_NET_OF_SPLITWISE_BALANCE}"
+        )
+        self.connection.execute(
+            """
+            update plaid
+               set amount = (select amount from venmo_income where venmo_income.rowid = plaid.rowid)
+            """
+        )
+        self.connection.execute("drop table venmo_income")
+
+    def apply_group_shares(self):
+        self._replace_plaid(TRANSACTIONS_WITH_MY_SHARE_OF_GROUP_AMOUNTS)
+
+    def amounts(self, ids):
+        placeholders = ", ".join("?" for _ in ids)
+        return pd.read_sql_query(
+            f"select id, amount from plaid where id in ({placeholders})",
+            self.connection,
+            params=list(ids),
+        )
+
+    def get_df(self):
+        return pd.read_sql_query("select * from plaid", self.connection)
+
+    def close(self):
+        self.connection.close()
+
+
+class NativeSession:
+    """The same steps run with the band joins in mosaic.transform.reconcile on frames in memory"""
+
+    def __init__(self, plaid, splitwise):
+        self.plaid = plaid
+        self.splitwise = splitwise
+
+    def totals(self):
+        return len(self.plaid), round(sum(self.plaid["amount"]), 2)
+
+    def drop_venmo_payments(self):
+        self.plaid = reconcile.drop_venmo_payments(self.plaid, self.splitwise)
+
+    def net_venmo_income(self):
+        self.plaid["amount"] = reconcile.net_venmo_income(self.plaid, self.splitwise)
+
+    def apply_group_shares(self):
+        self.plaid = reconcile.apply_group_shares(self.plaid, self.splitwise)
+
+    def amounts(self, ids):
+        return self.plaid.loc[self.plaid["id"].isin(ids), ["id", "amount"]]
+
+    def get_df(self):
+        return self.plaid
+
+    def close(self):
+        pass
+
+
+SESSIONS = {"native": NativeSession, "sql": SqlSession}
+
+
+def verbose_step(session, step):
+    """Runs one reconciliation step and logs how it changed the row count and total"""
+    t = PrettyTable()
+    t.set_style(PLAIN_COLUMNS)
+    t.add_column("old", list(session.totals()))
+    step()
+    t.add_column("new", list(session.totals()))
+    getLogger.info(t)
+
+
+def transform_transactions(
+    start_date,
+    end_date,
+    extract_plaid_endpoints,
+    extract_splitwise_endpoint,
+    output_path,
+    engine="native",
+    rules_path=RULES_PATH,
+):
+    rules = TransactionRules.from_yaml(rules_path)
+    # Only transactions in the window are reported, and each is matched to expenses at most a few weeks
+    # away, so neither input is read beyond that
+    plaid = read_plaid_transactions(extract_plaid_endpoints, start_date, end_date)
+    splitwise = read_splitwise_expenses(
+        extract_splitwise_endpoint, *reconcile.splitwise_window(start_date, end_date)
     )
-    plaid = verbose_query(plaid, splitwise, TRANSACTIONS_WITH_MY_SHARE_OF_GROUP_AMOUNTS)
+
+    if engine not in SESSIONS:
+        raise ValueError(f"Unknown reconciliation engine {engine}")
+    session = SESSIONS[engine](plaid, splitwise)
+    try:
+        getLogger.info(
+            "Lump payments and income from Venmo disguise how cash is actually being spent, which is captured by Splitwise"
+        )
+        verbose_step(session, session.drop_venmo_payments)
+
+        getLogger.info(f"For my income from Venmo, removing Splitwise share from the total")
+        verbose_step(session, session.net_venmo_income)
+        getLogger.debug(
+            f"""Shared Venmo payments after adjustment\n{session.amounts(rules.traced_ids())}"""
+        )
+
+        getLogger.info(
+            "Now that we have adjusted the lump payments, we can layer in Splitwise transactions to get a more nuanced understanding of spending"
+        )
+        getLogger.info(
+            f"For group expenses paid by me, replacing full amount from Plaid with my share from Splitwise"
+        )
+        verbose_step(session, session.apply_group_shares)
+        plaid = session.get_df()
+    finally:
+        session.close()
 
     getLogger.info(
         f"For group expenses paid by others, appending my share from Splitwise"
@@ -127,23 +243,15 @@ def transform_transactions(
     t.add_column("new", [len(plaid), round(sum(plaid["amount"]), 2)])
     getLogger.info(t)
 
-    getLogger.info("Dropping edge cases for expenses handled by Splitwise")
+    getLogger.info(f"Applying exclusions and flags from {rules_path}")
     ct, amt = len(plaid), sum(plaid["amount"])
-    getLogger.debug(
-        "Dropping insurance expenses which occur on an odd cadence and are split between homeowners and car insurance in Plaid but are unified in Splitwise"
-    )
-    plaid = plaid.loc[~plaid["name"].isin(["HOMEOWNERS INSURANCE", "GEICO"])]
-    getLogger.debug(
-        "Amazon grocery tips are counted separately from the grocery bill but are included in the Splitwise amount."
-    )
-    plaid = plaid.loc[~(plaid["name"].apply(lambda s: s[:11]) == "Amazon Tips")]
+    plaid = rules.apply(plaid)
     new_ct, new_amt = len(plaid), sum(plaid["amount"])
     getLogger.info(
         f"Removed {new_ct - ct} rows, resulting in a ${new_amt - amt:.2f} change in cash flow to ${new_amt:.2f}"
     )
 
-    getLogger.info("Enriching with time dimensions and categories")
-    plaid["is_variable"] = ~plaid["category"].isin(["income", "transfer", "housing"])
+    getLogger.info("Enriching with time dimensions")
     plaid = plaid.loc[
         convert_vector_to_date(plaid["date"]).between(start_date, end_date),
     ]
@@ -151,7 +259,7 @@ def transform_transactions(
     plaid["month"] = date_period_vector(plaid["date"], "M")
 
     getLogger.info(f"Saving processed data to {output_path}\n{plaid.info()}")
-    plaid.to_csv(output_path, index=False)
+    to_csv_atomically(plaid, output_path, index=False)
 
 
 if __name__ == "__main__":
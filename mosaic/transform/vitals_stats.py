@@ -0,0 +1,187 @@
+import json
+import logging as getLogger
+import os
+import numpy as np
+import pandas as pd
+from mosaic.fingerprint import hash_file
+from mosaic.storage import OutputFile, Schema, days_since_epoch
+from mosaic.utils import to_csv_atomically
+
+
+# Each metric's extract endpoint, value column and the factor converting it to the reported unit
+METRICS = {
+    "resting_heart_rate": ("activities/heart", "restingHeartRate", 1),
+    "sleep_hours": ("sleep", "minutesAsleep", 1 / 60),
+    "weight": ("body/weight", "value", 1),
+    "bmi": ("body/bmi", "value", 1),
+}
+WINDOWS = [7, 28, 90]
+# A metric's baseline is its 90 day mean as of a week ago, so this week's mean can be compared against it
+BASELINE_DAYS = 90
+BASELINE_LAG_DAYS = 7
+# Days before the earliest changed day whose values every statistic of a changed day depends on
+CONTEXT_DAYS = max(max(WINDOWS), BASELINE_DAYS + BASELINE_LAG_DAYS)
+
+
+def stat_columns(metric):
+    return [
+        *(f"{metric}_{window}d" for window in WINDOWS),
+        f"{metric}_baseline",
+        f"{metric}_latest",
+    ]
+
+
+HISTORY_SCHEMA = {
+    "id": "int64",
+    "date": "datetime64[ns]",
+    **{
+        col: "float64"
+        for metric in METRICS
+        for col in [metric, *stat_columns(metric)]
+    },
+}
+
+
+class StatsState:
+    """JSON sidecar recording, per metric, the last extracted day already folded into the history,
+    and which version of this module computed it"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return json.load(f)
+        else:
+            return None
+
+    def write(self, state):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(temporary_path, self.path)
+
+
+def state_path(history_path):
+    return os.path.splitext(history_path)[0] + ".state.json"
+
+
+def history_files(history_path):
+    """The history's partition directory and its state sidecar, which history_path itself names"""
+    return [os.path.splitext(history_path)[0], state_path(history_path)]
+
+
+def read_daily_values(endpoint_config, value_col, factor, since=None):
+    """One value per day from an extract, reading only days on or after since"""
+    extract = OutputFile.from_config(endpoint_config)
+    df = extract.get_df(columns=["date", value_col], start_date=since)
+    # Days with several entries, like naps, are averaged as the long vitals table was when pivoted
+    daily = df.groupby(df["date"].dt.normalize())[value_col].mean() * factor
+    return daily, extract.get_latest_row_date()
+
+
+def rolling_stats(daily, seeds):
+    """Trailing means, baselines and latest values for a frame holding one row per calendar day.
+    seeds are each metric's latest value before the frame's first day."""
+    stats = daily.copy()
+    for metric in METRICS:
+        values = daily[metric]
+        for window in WINDOWS:
+            stats[f"{metric}_{window}d"] = values.rolling(window, min_periods=1).mean()
+        stats[f"{metric}_baseline"] = (
+            values.rolling(BASELINE_DAYS, min_periods=1).mean().shift(BASELINE_LAG_DAYS)
+        )
+        stats[f"{metric}_latest"] = values.ffill().fillna(seeds.get(metric, np.nan))
+    return stats
+
+
+def transform_vitals_stats(
+    extract_fitbit_endpoints,
+    start_date,
+    end_date,
+    output_path,
+    history_path,
+):
+    """Keeps a wide table of daily vitals and their statistics up to date from only the days the
+    extracts added since the last run, and writes the reporting window of it to output_path"""
+    history = OutputFile(history_path, Schema(HISTORY_SCHEMA), "parquet", "year")
+    history.create_path()
+    state_store = StatsState(state_path(history_path))
+    state = state_store.read()
+    code = hash_file(__file__)
+    if state is None or state["code"] != code or not history.exists():
+        getLogger.info(f"Rebuilding vitals statistics in {history.partition_directory}")
+        state = {"code": code, "watermarks": {}}
+        rebuild = True
+    else:
+        rebuild = False
+
+    # Incremental extracts only ever rewrite days from their previous latest day on
+    changed = {}
+    watermarks = {}
+    for metric, (endpoint, value_col, factor) in METRICS.items():
+        since = state["watermarks"].get(metric)
+        since = None if since is None else pd.Timestamp(since)
+        daily, latest_row_date = read_daily_values(
+            extract_fitbit_endpoints[endpoint], value_col, factor, since
+        )
+        changed[metric] = (since, daily)
+        watermarks[metric] = None if latest_row_date is None else str(latest_row_date)
+    new_days = [
+        since if since is not None else daily.index.min()
+        for since, daily in changed.values()
+        if since is not None or not daily.empty
+    ]
+    if not new_days:
+        getLogger.info("No vitals have been extracted yet")
+        return
+    changed_from = min(new_days)
+    last_day = max(
+        [daily.index.max() for _, daily in changed.values() if not daily.empty]
+        + ([] if rebuild else [pd.Timestamp(history.get_metadata()["max_date"])])
+    )
+
+    # Stored values are only needed as far back as the oldest day a changed day's windows reach, plus
+    # the day before for the latest values carried into them
+    context_start = changed_from - pd.Timedelta(days=CONTEXT_DAYS)
+    stored = (
+        history.get_df(start_date=context_start - pd.Timedelta(days=1))
+        if not rebuild
+        else history.schema.conform(pd.DataFrame(columns=list(HISTORY_SCHEMA)))
+    )
+    stored = stored.set_index("date").sort_index()
+    before = stored.loc[stored.index < context_start]
+    seeds = {
+        metric: before[f"{metric}_latest"].iloc[-1] if not before.empty else np.nan
+        for metric in METRICS
+    }
+    stored = stored.loc[stored.index >= context_start]
+    days = pd.date_range(
+        min(stored.index.min(), changed_from) if not stored.empty else changed_from,
+        last_day,
+        freq="D",
+        name="date",
+    )
+    daily = stored.reindex(days)[list(METRICS)]
+    for metric, (since, values) in changed.items():
+        # Days reread from the extract are replaced outright, so a deleted reading clears its day
+        if since is not None:
+            daily.loc[daily.index >= since, metric] = np.nan
+        daily.loc[values.index, metric] = values
+    stats = rolling_stats(daily, seeds)
+    stats = stats.loc[stats.index >= changed_from].reset_index()
+    stats["id"] = days_since_epoch(stats["date"])
+    if rebuild:
+        history.write(stats)
+    else:
+        history.merge(stats)
+    state_store.write({"code": code, "watermarks": watermarks})
+    getLogger.info(
+        f"Updated vitals statistics for {len(stats)} days from {changed_from:%Y-%m-%d}"
+    )
+
+    report = history.get_df(start_date=start_date, end_date=end_date)
+    to_csv_atomically(
+        report.drop(columns="id").sort_values("date"), output_path, index=False
+    )
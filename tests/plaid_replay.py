@@ -0,0 +1,43 @@
+import json
+import sys
+import uuid
+from flask import Flask, jsonify, request
+
+
+def create_app(pages):
+    """Serves /transactions/sync from pages recorded by TransactionsSyncer, so sync runs can be
+    reproduced without touching Plaid. Each page is served to the cursor that requested it."""
+    app = Flask(__name__)
+    pages_by_cursor = {}
+    cursor = ""
+    for page in pages:
+        pages_by_cursor[cursor] = page
+        cursor = page["next_cursor"]
+
+    @app.route("/transactions/sync", methods=["POST"])
+    def transactions_sync():
+        cursor = request.get_json().get("cursor") or ""
+        # Once caught up there is nothing new to report
+        page = pages_by_cursor.get(
+            cursor,
+            {
+                "added": [],
+                "modified": [],
+                "removed": [],
+                "has_more": False,
+                "next_cursor": cursor,
+                "accounts": [],
+                "transactions_update_status": "HISTORICAL_UPDATE_COMPLETE",
+            },
+        )
+        return jsonify({**page, "request_id": uuid.uuid4().hex[:15]})
+
+    return app
+
+
+if __name__ == "__main__":
+    # python tests/plaid_replay.py pages.json [port]
+    with open(sys.argv[1], "r") as f:
+        recorded_pages = json.load(f)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8001
+    create_app(recorded_pages).run(port=port)
@@ -0,0 +1,16 @@
+from mosaic.fingerprint import TransformFingerprint
+
+
+def test_missing_secondary_output_makes_fingerprint_stale(tmp_path):
+    output_path = tmp_path / "heart_rate_hourly.csv"
+    zones_output_path = tmp_path / "heart_rate_zones_daily.csv"
+    for path in [output_path, zones_output_path]:
+        path.write_text("date\n")
+    fingerprint = TransformFingerprint(
+        str(output_path), [], {"start_date": "2023-06-01"}, other_output_paths=[str(zones_output_path)]
+    )
+    current = fingerprint.compute()
+    fingerprint.update(current)
+    assert fingerprint.is_current(current)
+    zones_output_path.unlink()
+    assert not fingerprint.is_current(current)
@@ -0,0 +1,59 @@
+import json
+import os
+import numpy as np
+import pytest
+from mosaic.clients import CLIENTS
+from mosaic.storage import OutputFile
+from mosaic.utils import lookup_yaml
+
+plaid_extract = pytest.importorskip("mosaic.extract.plaid")
+plaid_replay = pytest.importorskip("plaid_replay")
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), "plaid_replay_fixture.json")
+
+
+class ReplayClient:
+    """Stands in for plaid_api.PlaidApi, answering /transactions/sync from the replay app"""
+
+    def __init__(self, app):
+        self.app = app.test_client()
+
+    def transactions_sync(self, request):
+        cursor = request.to_dict().get("cursor")
+        page = self.app.post("/transactions/sync", json={"cursor": cursor}).get_json()
+        return type("Response", (), {"to_dict": lambda self: page})()
+
+
+def test_removals_only_sync_deletes_the_added_transaction(tmp_path, monkeypatch):
+    with open(FIXTURE_PATH, "r") as f:
+        app = plaid_replay.create_app(json.load(f))
+    monkeypatch.setattr(plaid_extract, "get_client", lambda **creds: ReplayClient(app))
+    CLIENTS.clear()
+    endpoint_config = lookup_yaml("etl_config.yml")["extract"]["plaid"]["endpoints"]["chase"]
+    output_file = OutputFile(
+        str(tmp_path / "chase.csv"), OutputFile.from_config(endpoint_config).schema
+    )
+    creds = {"client_id": "id", "client_secret": "secret", "chase": {"access_token": "token"}}
+
+    def sync():
+        df = plaid_extract.extract_plaid(
+            creds,
+            np.datetime64("2023-06-01"),
+            np.datetime64("2023-06-30"),
+            "chase",
+            output_file=output_file,
+            sync=True,
+        )
+        if output_file.exists():
+            output_file.merge(df)
+        else:
+            output_file.write(df)
+        output_file.cursor.commit()
+
+    sync()
+    assert output_file.get_df()["id"].tolist() == ["lPNjeW1nR6CDn5okmGQ6hEpMo4lLNoSrzqDje"]
+    sync()
+    assert output_file.get_df().empty
+    assert output_file.get_replaced_ids() == []
+    assert output_file.cursor.read() == "cursor-2"
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from mosaic.transform.transactions import NativeSession, SqlSession
+
+
+STEPS = ["drop_venmo_payments", "net_venmo_income", "apply_group_shares"]
+
+
+def synthetic_transactions(transactions=5000, expenses=3000, seed=0):
+    """Plaid and Splitwise frames shaped like the transform's inputs, with dates as ISO strings, dense
+    enough that every rule matches plenty of pairs"""
+    rng = np.random.default_rng(seed)
+    days = pd.date_range("2023-01-01", periods=120).strftime("%Y-%m-%d").to_numpy()
+    categories = np.array(["groceries", "restaurants", "general", "housing", None], dtype=object)
+    names = np.array(
+        ["Venmo", "Amazon Fresh", "AMAZON MKTPLACE", "Convenience Check Adjustment", "Safeway", None],
+        dtype=object,
+    )
+    plaid = pd.DataFrame(
+        {
+            "id": [f"t{i}" for i in range(transactions)],
+            "name": rng.choice(names, transactions),
+            "date": rng.choice(days, transactions),
+            "category": rng.choice(categories, transactions),
+            "merchant_name": None,
+            "account": rng.choice(["aspiration", "chase"], transactions),
+            "amount": rng.integers(-400, 400, transactions) + rng.choice([0, 0.5], transactions),
+        }
+    )
+    splitwise = pd.DataFrame(
+        {
+            "id": np.arange(expenses),
+            "date": rng.choice(days, expenses),
+            "description": "expense",
+            "is_payment": rng.random(expenses) < 0.3,
+            "cost": 0.0,
+            "category": rng.choice(categories, expenses),
+            "user_names": "['Me', 'You']",
+            "net_balance": rng.integers(-400, 400, expenses) + rng.choice([0, 0.5], expenses),
+            "paid_share": rng.choice([0, 10, 25.5, 120, 390], expenses),
+            "owed_share": 0.0,
+            "group_id": 1.0,
+            "group_name": "Home",
+        }
+    )
+    # Venmo income nets out at most one repayment, so negative ones are spaced beyond its 20 day window
+    is_payment = splitwise["is_payment"]
+    splitwise.loc[is_payment, "net_balance"] = splitwise.loc[is_payment, "net_balance"].abs()
+    repayments = np.flatnonzero(is_payment)[: len(days) // 25]
+    splitwise.loc[repayments, "date"] = days[::25][: len(repayments)]
+    splitwise.loc[repayments, "net_balance"] = -rng.integers(1, 400, len(repayments))
+    return plaid, splitwise
+
+
+@pytest.fixture(scope="module")
+def sessions():
+    plaid, splitwise = synthetic_transactions()
+    sessions = {
+        "sql": SqlSession(plaid, splitwise),
+        "native": NativeSession(plaid.copy(), splitwise),
+    }
+    yield sessions
+    for session in sessions.values():
+        session.close()
+
+
+# Steps run in order on the same sessions, so each is compared on the output of the one before
+@pytest.mark.parametrize("step", STEPS)
+def test_native_band_joins_match_sql(sessions, step):
+    results = {}
+    for engine, session in sessions.items():
+        getattr(session, step)()
+        results[engine] = session.get_df()
+    expected, actual = results["sql"], results["native"]
+    # Both engines keep plaid's order but may order one transaction's matches differently
+    expected = expected[actual.columns].sort_values(["id", "amount", "category"], kind="stable")
+    actual = actual.sort_values(["id", "amount", "category"], kind="stable")
+    pd.testing.assert_frame_equal(
+        actual.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False
+    )